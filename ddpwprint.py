@@ -15,7 +15,12 @@
 #               permission of the author.
 
 import sys
+import os
+import io
 import re
+import unicodedata
+from collections import OrderedDict, deque
+from optparse import OptionParser
 
 
 phoneticascii = {
@@ -77,7 +82,7 @@ phoneticascii = {
     chr(87): 'upper_whiskey',
     chr(88): 'upper_xray',
     chr(89): 'upper_yankee',
-    chr(90): 'zulu',
+    chr(90): 'upper_zulu',
     chr(91): 'left_bracket',
     chr(92): 'backslash',
     chr(93): 'right_bracket',
@@ -116,6 +121,163 @@ phoneticascii = {
     chr(126): 'tilde'
     }
 
+DIGITS = '0123456789'
+LOWER = 'abcdefghijklmnopqrstuvwxyz'
+UPPER = LOWER.upper()
+
+# Letters and digits only, spelled the way ICAO and NATO spell them
+NATOWORDS = ['alfa', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+             'hotel', 'india', 'juliett', 'kilo', 'lima', 'mike', 'november',
+             'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango',
+             'uniform', 'victor', 'whiskey', 'xray', 'yankee', 'zulu']
+natoascii = dict((x, phoneticascii[x]) for x in DIGITS)
+natoascii['9'] = 'niner'
+natoascii.update(zip(LOWER, NATOWORDS))
+natoascii.update(zip(UPPER, ['upper_' + x for x in NATOWORDS]))
+
+# Characters that pass for ASCII on paper, on top of phoneticascii
+confusables = {
+    u'\u00a0': 'no_break_space',
+    u'\u00ad': 'soft_hyphen',
+    u'\u00b7': 'middle_dot',
+    u'\u0131': 'dotless_i',
+    u'\u01c0': 'dental_click',
+    u'\u0391': 'greek_upper_alpha',
+    u'\u0392': 'greek_upper_beta',
+    u'\u0395': 'greek_upper_epsilon',
+    u'\u0396': 'greek_upper_zeta',
+    u'\u0397': 'greek_upper_eta',
+    u'\u0399': 'greek_upper_iota',
+    u'\u039a': 'greek_upper_kappa',
+    u'\u039c': 'greek_upper_mu',
+    u'\u039d': 'greek_upper_nu',
+    u'\u039f': 'greek_upper_omicron',
+    u'\u03a1': 'greek_upper_rho',
+    u'\u03a4': 'greek_upper_tau',
+    u'\u03a5': 'greek_upper_upsilon',
+    u'\u03a7': 'greek_upper_chi',
+    u'\u03b1': 'greek_alpha',
+    u'\u03bd': 'greek_nu',
+    u'\u03bf': 'greek_omicron',
+    u'\u0410': 'cyrillic_upper_a',
+    u'\u0412': 'cyrillic_upper_ve',
+    u'\u0415': 'cyrillic_upper_ie',
+    u'\u041a': 'cyrillic_upper_ka',
+    u'\u041c': 'cyrillic_upper_em',
+    u'\u041d': 'cyrillic_upper_en',
+    u'\u041e': 'cyrillic_upper_o',
+    u'\u0420': 'cyrillic_upper_er',
+    u'\u0421': 'cyrillic_upper_es',
+    u'\u0422': 'cyrillic_upper_te',
+    u'\u0425': 'cyrillic_upper_ha',
+    u'\u0430': 'cyrillic_a',
+    u'\u0435': 'cyrillic_ie',
+    u'\u043e': 'cyrillic_o',
+    u'\u0440': 'cyrillic_er',
+    u'\u0441': 'cyrillic_es',
+    u'\u0443': 'cyrillic_u',
+    u'\u0445': 'cyrillic_ha',
+    u'\u0455': 'cyrillic_dze',
+    u'\u0456': 'cyrillic_i',
+    u'\u0458': 'cyrillic_je',
+    u'\u200b': 'zwsp',
+    u'\u200c': 'zwnj',
+    u'\u200d': 'zwj',
+    u'\u2010': 'hyphen',
+    u'\u2011': 'non_breaking_hyphen',
+    u'\u2012': 'figure_dash',
+    u'\u2013': 'en_dash',
+    u'\u2014': 'em_dash',
+    u'\u2018': 'left_single_quote',
+    u'\u2019': 'right_single_quote',
+    u'\u201c': 'left_double_quote',
+    u'\u201d': 'right_double_quote',
+    u'\u2032': 'prime',
+    u'\u2033': 'double_prime',
+    u'\u2044': 'fraction_slash',
+    u'\u2212': 'math_minus',
+    u'\u2215': 'division_slash',
+    u'\ufeff': 'zwnbsp',
+    }
+phoneticunicode = dict(phoneticascii)
+phoneticunicode.update(confusables)
+
+ALPHABETS = OrderedDict([
+    ('ascii', phoneticascii),
+    ('nato', natoascii),
+    ('unicode', phoneticunicode),
+    ])
+
+CHUNKSIZE = 1 << 20
+INDENT = b'         '
+HEADER = b'\n--\nPassword:  '
+
+
+def phonetictable(alphabet=phoneticascii):
+    '''Returns a list of 256 output lines, one per byte value, holding the
+    indented phonetic name from alphabet or nothing after the indent for a
+    byte it has no name for.  Translating is then one index per byte.'''
+    table = []
+    for code in range(256):
+        name = alphabet.get(chr(code), '')
+        table.append(INDENT + name.encode('ascii') + b'\n')
+    return(table)
+
+
+class Alphabet(object):
+    '''One of ALPHABETS compiled for translation.  An alphabet of ASCII
+    characters translates bytes through a phonetictable().  A wider one
+    decodes records as UTF-8 and looks up each character, naming those it
+    has no spelling for after their Unicode name, which it then keeps.'''
+
+    def __init__(self, spellings):
+        self.spellings = spellings
+        self.wide = any(ord(x) > 127 for x in spellings)
+        self.lines = phonetictable(spellings)
+        self.charlines = dict((x, INDENT + name.encode('ascii') + b'\n')
+                              for x, name in spellings.items())
+        self.decoder = None
+
+    def describe(self, char):
+        '''Returns the output line of a character without a spelling.'''
+        if ord(char) < 128:
+            line = INDENT + b'\n'
+        else:
+            name = unicodedata.name(char, 'u+%04x' % ord(char))
+            line = (INDENT + re.sub('[^a-z0-9+]+', '_', name.lower()).encode(
+                'ascii') + b'\n')
+        self.charlines[char] = line
+        return(line)
+
+    def render(self, record):
+        '''Returns the header and one spelled line per character of
+        record, a byte string, as one byte string.'''
+        if not self.wide:
+            return(HEADER + record + b'\n' +
+                   b''.join(map(self.lines.__getitem__, bytearray(record))))
+        get = self.charlines.get
+        describe = self.describe
+        return(HEADER + record + b'\n' +
+               b''.join([get(x) or describe(x)
+                         for x in record.decode('utf-8', 'replace')]))
+
+    def trie(self):
+        '''Returns the phonetictrie() of this alphabet, built once.'''
+        if self.decoder is None:
+            self.decoder = phonetictrie(self.spellings)
+        return(self.decoder)
+
+
+compiled = {}
+
+
+def getalphabet(name='ascii'):
+    '''Returns the Alphabet for name in ALPHABETS, compiling it on first
+    use.  Raises KeyError for an unknown name.'''
+    if name not in compiled:
+        compiled[name] = Alphabet(ALPHABETS[name])
+    return(compiled[name])
+
 
 def phonetic(inchar=''):
     '''Tries to return a phonetic value from the ASCII dictionary.  Returns
@@ -134,24 +296,476 @@ def getphonetic(intext):
     except:
         sys.stderr.write('Your input isn\'t a string.  Sorry.\n')
         return(False)
-    outtext = map(phonetic, intext)
+    outtext = list(map(phonetic, intext))
     return(outtext)
 
 
-def printphonetic(intext):
+def tobytes(intext):
+    '''Returns intext as a byte string, encoding text the way the command
+    line was decoded.'''
+    if isinstance(intext, bytes):
+        return(intext)
+    return(intext.encode(sys.getfilesystemencoding() or 'utf-8',
+                         'surrogateescape'))
+
+
+def renderphonetic(record, alphabet='ascii'):
+    '''Returns everything printphonetic() writes for record, a byte string,
+    as one byte string: the header and one line per character, spelled in
+    the named alphabet.'''
+    return(getalphabet(alphabet).render(record))
+
+
+def stdoutbytes():
+    '''Returns the binary stream under sys.stdout.'''
+    return(getattr(sys.stdout, 'buffer', sys.stdout))
+
+
+def printphonetic(intext, outstream=None, alphabet='ascii'):
     '''Iterates over intext.  Anything set off in quotes is treated as one
-    entry, unless you escape the quotes.'''
-    sys.stdout.write('\n--\nPassword:  ' + intext + '\n')
-    outtext = getphonetic(intext)
-    if outtext:
-        map(lambda x:  sys.stdout.write('         ' + x + '\n'), outtext)
-        return(True)
-    else:
+    entry, unless you escape the quotes.  The whole entry goes out in one
+    write to outstream, a binary stream that defaults to stdout.'''
+    try:
+        record = tobytes(intext)
+    except (AttributeError, UnicodeError):
+        sys.stderr.write('Your input isn\'t a string.  Sorry.\n')
         return(False)
+    (outstream or stdoutbytes()).write(renderphonetic(record, alphabet))
+    return(True)
+
+
+def linechunks(instream, chunksize=CHUNKSIZE):
+    '''Yields runs of whole lines from instream, a binary stream read
+    chunksize bytes at a time, each without its last line ending.'''
+    tail = b''
+    while True:
+        chunk = instream.read(chunksize)
+        if not chunk:
+            break
+        chunk = tail + chunk
+        cut = chunk.rfind(b'\n')
+        if cut < 0:
+            tail = chunk
+            continue
+        yield(chunk[:cut])
+        tail = chunk[cut + 1:]
+    if tail:
+        yield(tail)
+
+
+def splitlines(chunk):
+    '''Returns the lines of a linechunks() chunk without line endings.'''
+    lines = chunk.split(b'\n')
+    if b'\r' in chunk:
+        lines = [x[:-1] if x.endswith(b'\r') else x for x in lines]
+    return(lines)
+
+
+def streamlines(instream, chunksize=CHUNKSIZE):
+    '''Yields every line of instream, a binary stream read chunksize bytes
+    at a time, without its line ending.'''
+    for chunk in linechunks(instream, chunksize):
+        for line in splitlines(chunk):
+            yield(line)
+
+
+def streamphonetic(instream, outstream, chunksize=CHUNKSIZE,
+                   alphabet='ascii'):
+    '''Translates every line of instream, a binary stream read chunksize
+    bytes at a time, onto outstream with one write per line.  Line endings
+    are not part of the entry.  Returns the number of lines.'''
+    write = outstream.write
+    render = getalphabet(alphabet).render
+    count = 0
+    for line in streamlines(instream, chunksize):
+        write(render(line))
+        count += 1
+    return(count)
+
+
+def translatechunk(job):
+    '''Returns the translation of every line in a linechunks() chunk as
+    one byte string.  job is a tuple of the alphabet name and the chunk, so
+    that it can be handed to a worker process.'''
+    alphabet, chunk = job
+    return(b''.join(map(getalphabet(alphabet).render, splitlines(chunk))))
+
+
+def poolmap(pool, function, jobs, window):
+    '''Yields function of every job in jobs, in order, computed on pool
+    with at most window of them queued or unread at a time.'''
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(function, (job,)))
+        if len(pending) >= window:
+            yield(pending.popleft().get())
+    while pending:
+        yield(pending.popleft().get())
+
+
+def translatefiles(names, outstream, alphabet='ascii', workers=1,
+                   chunksize=CHUNKSIZE):
+    '''Translates every line of the files in names, or stdin, onto
+    outstream in order.  Chunks of whole lines are spread over workers
+    processes once there is more than one chunk.  Each chunk's output is
+    written in one go.  Returns the number of chunks.'''
+    getalphabet(alphabet)
+    jobs = ((alphabet, chunk) for instream in inputstreams(names)
+            for chunk in linechunks(instream, chunksize))
+    first = next(jobs, None)
+    second = next(jobs, None)
+    if first is None:
+        return(0)
+    if workers <= 1 or second is None:
+        count = 0
+        for job in (first, second):
+            if job is not None:
+                outstream.write(translatechunk(job))
+                count += 1
+        for job in jobs:
+            outstream.write(translatechunk(job))
+            count += 1
+        return(count)
+    import itertools
+    import multiprocessing
+    count = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        for output in poolmap(pool, translatechunk,
+                              itertools.chain([first, second], jobs),
+                              workers * 4):
+            outstream.write(output)
+            count += 1
+    finally:
+        pool.terminate()
+    return(count)
+
+
+WORDSPLIT = re.compile('[^a-z]+')
+
+
+def phonetictrie(alphabet=phoneticascii):
+    '''Returns the inverse of alphabet as a trie of dictionaries keyed by
+    lowercase word, so upper_alpha is found under 'upper' then 'alpha'.  A
+    leaf is the character itself.  Every spelling is also reachable glued
+    together as one word, such as 'upperalpha'.  Raises ValueError if two
+    characters share a spelling or one spelling starts another.'''
+    trie = {}
+    glued = {}
+    for char, name in sorted(alphabet.items()):
+        words = name.lower().split('_')
+        node = trie
+        for word in words[:-1]:
+            node = node.setdefault(word, {})
+            if not isinstance(node, dict):
+                raise ValueError('spelling of ' + repr(char) +
+                                 ' starts with another')
+        if words[-1] in node:
+            raise ValueError('spelling of ' + repr(char) + ' is taken')
+        node[words[-1]] = char
+        if len(words) > 1:
+            glued[''.join(words)] = char
+    for word, char in glued.items():
+        if word in trie:
+            raise ValueError('spelling of ' + repr(char) + ' is taken')
+        trie[word] = char
+    return(trie)
+
+
+class PhoneticDecoder(object):
+    '''Turns spoken-form readbacks back into text through a phonetictrie().
+    Spellings may be in any case, and their words joined by any run of
+    non-letters or by nothing at all.  Each word costs one dictionary
+    lookup, so decoding is linear in the input.'''
+
+    def __init__(self, alphabet='ascii'):
+        self.trie = getalphabet(alphabet).trie()
+
+    def decode(self, text):
+        '''Returns a tuple of the text spelled out in text and a list of
+        the spellings in it that were not recognised and left out.'''
+        root = self.trie
+        node = root
+        pending = []
+        chars = []
+        unknown = []
+        for word in WORDSPLIT.split(text.lower()):
+            if not word:
+                continue
+            step = node.get(word)
+            if step is None and node is not root:
+                unknown.append('_'.join(pending))
+                pending = []
+                node = root
+                step = root.get(word)
+            if step is None:
+                unknown.append(word)
+            elif isinstance(step, dict):
+                node = step
+                pending.append(word)
+            else:
+                chars.append(step)
+                node = root
+                pending = []
+        if pending:
+            unknown.append('_'.join(pending))
+        return((''.join(chars), unknown))
+
+
+def firstmismatch(decoded, reference, legacyzulu=False):
+    '''Returns the position, counting from 1, of the first character where
+    decoded differs from reference, or 0 if they are the same.  With
+    legacyzulu, a z matches a Z, for sheets printed when Z was spelled zulu
+    just like z.
+    >>> firstmismatch('aZ', 'aZ'), firstmismatch('az', 'aZ')
+    (0, 2)
+    >>> firstmismatch('az', 'aZ', legacyzulu=True)
+    0
+    '''
+    if decoded == reference:
+        return(0)
+    for index, (got, want) in enumerate(zip(decoded, reference)):
+        if got != want and not (legacyzulu and got == 'z' and want == 'Z'):
+            return(index + 1)
+    if len(decoded) != len(reference):
+        return(min(len(decoded), len(reference)) + 1)
+    return(0)
+
+
+def inputstreams(names):
+    '''Yields a binary stream for each file name in names, or for stdin
+    if there are none or the name is -.  A stream in names is yielded as
+    it is.'''
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    for name in names or ['-']:
+        if hasattr(name, 'read'):
+            yield(name)
+            continue
+        if name == '-':
+            yield(stdin)
+            continue
+        with io.open(name, 'rb') as instream:
+            yield(instream)
+
+
+def decodephonetic(names, outstream, reference=None, alphabet='ascii',
+                   legacyzulu=False):
+    '''Decodes every line of the files in names, or stdin, with one
+    decoded line written to outstream each.  With reference, a binary
+    stream of the expected text one line apiece, writes instead the line
+    number and first mismatch of every line that does not match.  Unknown
+    spellings are reported on stderr.  Returns the number of lines that
+    failed.  Text and reference are UTF-8 when the alphabet is wide.
+    legacyzulu is passed on to firstmismatch().
+    >>> out = io.BytesIO()
+    >>> decodephonetic([io.BytesIO(b'greek upper alpha bravo\\n')], out,
+    ...                alphabet='unicode')
+    0
+    >>> out.getvalue() == u'\\u0391b\\n'.encode('utf-8')
+    True
+    >>> decodephonetic([io.BytesIO(b'greek upper alpha bravo\\n')], out,
+    ...                io.BytesIO(out.getvalue()), 'unicode')
+    0
+    '''
+    decoder = PhoneticDecoder(alphabet)
+    encoding = 'utf-8' if getalphabet(alphabet).wide else 'latin-1'
+    expected = None
+    if reference is not None:
+        expected = streamlines(reference)
+    failed = 0
+    number = 0
+    for instream in inputstreams(names):
+        for line in streamlines(instream):
+            number += 1
+            text, unknown = decoder.decode(line.decode('latin-1'))
+            if unknown:
+                sys.stderr.write('line %d: cannot decode %s\n' %
+                                 (number, ' '.join(unknown)))
+            if expected is None:
+                outstream.write(text.encode(encoding) + b'\n')
+                failed += bool(unknown)
+                continue
+            want = next(expected, b'').decode(encoding, 'replace')
+            position = firstmismatch(text, want, legacyzulu)
+            if position:
+                outstream.write(('%d: mismatch at character %d\n' %
+                                 (number, position)).encode('ascii'))
+                failed += 1
+    if expected is not None:
+        for want in expected:
+            number += 1
+            outstream.write(('%d: missing readback\n' %
+                             number).encode('ascii'))
+            failed += 1
+    return(failed)
+
+
+CHARSETS = OrderedDict([
+    ('printable', ''.join(chr(x) for x in range(33, 127))),
+    ('alnum', DIGITS + UPPER + LOWER),
+    ('alpha', UPPER + LOWER),
+    ('upper', UPPER),
+    ('lower', LOWER),
+    ('digits', DIGITS),
+    ('hex', DIGITS + 'abcdef'),
+    ('unambiguous', re.sub('[01IOl]', '', DIGITS + UPPER + LOWER)),
+    ])
+RANDOMBLOCK = 1 << 16
+GENERATEBATCH = 4096
+
+
+def getcharset(name, spellings=phoneticascii):
+    '''Returns the characters of the named entry in CHARSETS, or of name
+    itself taken as a literal set, as a byte string without repeats.
+    Raises ValueError for characters spellings cannot spell.'''
+    chars = CHARSETS.get(name, name)
+    unique = []
+    for char in chars:
+        if char not in spellings or ord(char) > 127:
+            raise ValueError('no phonetic spelling for ' + repr(char))
+        if char not in unique:
+            unique.append(char)
+    if not unique:
+        raise ValueError('empty character set')
+    return(''.join(unique).encode('ascii'))
+
+
+def randomchars(count, charset):
+    '''Returns count bytes drawn uniformly from charset, a byte string,
+    out of os.urandom in blocks.  A random byte at or above the largest
+    multiple of len(charset) would favour the first characters, so it is
+    thrown away; the rest map to charset by their remainder.  Both happen
+    in one translate() per block.'''
+    size = len(charset)
+    limit = 256 - 256 % size
+    chars = bytearray(charset)
+    table = bytes(bytearray(chars[x % size] for x in range(256)))
+    rejected = bytes(bytearray(range(limit, 256)))
+    blocks = []
+    have = 0
+    while have < count:
+        want = (count - have) * 256 // limit + 64
+        block = os.urandom(min(RANDOMBLOCK, want)).translate(table, rejected)
+        blocks.append(block)
+        have += len(block)
+    return(b''.join(blocks)[:count])
+
+
+def generatepasswords(count, length, charset, batch=GENERATEBATCH):
+    '''Yields lists of up to batch passwords, count in all, each length
+    bytes drawn from charset by randomchars().'''
+    while count > 0:
+        n = min(batch, count)
+        pool = randomchars(n * length, charset)
+        yield([pool[x:x + length] for x in range(0, n * length, length)])
+        count -= n
+
+
+def cpucount():
+    '''Returns the number of CPUs, or 1 if it cannot be told.'''
+    try:
+        return(os.cpu_count() or 1)
+    except AttributeError:
+        import multiprocessing
+        try:
+            return(multiprocessing.cpu_count())
+        except NotImplementedError:
+            return(1)
+
 
 def main(argv=[None]):
-    map(printphonetic, argv[1:])
-    map(printphonetic, sys.stdin)
+    parser = OptionParser(usage='%prog [options] [password ...]',
+                          description='Print passwords in phonetics to \
+                          correct for font problems.  Passwords come from \
+                          the command line, files, stdin or --generate.  \
+                          Put -- before a password that starts with a \
+                          dash.')
+    parser.add_option('-g', '--generate', dest='generate', action='store',
+                      type='int', help='Generate this many random passwords \
+                      instead of reading stdin.')
+    parser.add_option('-l', '--length', dest='length', action='store',
+                      type='int', help='Length of generated passwords.')
+    parser.add_option('-c', '--charset', dest='charset', action='store',
+                      help='Characters of generated passwords: one of ' +
+                      ', '.join(CHARSETS) + ', or the characters \
+                      themselves.  printable by default, or alnum when \
+                      the alphabet cannot spell printable.')
+    parser.add_option('-d', '--decode', dest='decode', action='store_true',
+                      help='Turn phonetic readbacks, one per line, from the \
+                      files named as arguments or stdin back into text.')
+    parser.add_option('--verify', dest='verify', action='store',
+                      help='Decode, and check each readback against the \
+                      same line of this file, reporting the first \
+                      mismatching character of each that differs.')
+    parser.add_option('--legacy-zulu', dest='legacyzulu',
+                      action='store_true', help='With --verify, accept z \
+                      for Z, as on sheets printed when Z was spelled zulu.')
+    parser.add_option('-a', '--alphabet', dest='alphabet', action='store',
+                      type='choice', choices=list(ALPHABETS),
+                      help='Spell with this alphabet: one of ' +
+                      ', '.join(ALPHABETS) + '.')
+    parser.add_option('-f', '--files', dest='files', action='store_true',
+                      help='Take the arguments as files of passwords, one \
+                      per line, rather than as passwords.  - is stdin.')
+    parser.add_option('-j', '--jobs', dest='jobs', action='store',
+                      type='int', help='Worker processes for files and \
+                      stdin, every CPU by default.')
+    parser.set_defaults(generate=0, length=16, charset=None,
+                        decode=False, verify=None, legacyzulu=False,
+                        alphabet='ascii',
+                        files=False, jobs=0)
+    (opts, args) = parser.parse_args(argv[1:])
+    if opts.generate < 0:
+        parser.error('--generate must not be negative')
+    if opts.length < 1:
+        parser.error('--length must be at least 1')
+    if opts.jobs < 0:
+        parser.error('--jobs must not be negative')
+    charset = None
+    if opts.generate:
+        spellings = ALPHABETS[opts.alphabet]
+        if opts.charset is None:
+            opts.charset = 'printable'
+            if any(x not in spellings for x in CHARSETS['printable']):
+                opts.charset = 'alnum'
+        try:
+            charset = getcharset(opts.charset, spellings)
+        except ValueError as e:
+            parser.error(str(e))
+
+    sys.stdout.flush()
+    outstream = io.open(stdoutbytes().fileno(), 'wb', buffering=CHUNKSIZE,
+                        closefd=False)
+    try:
+        if opts.verify:
+            with io.open(opts.verify, 'rb') as reference:
+                return(int(bool(decodephonetic(args, outstream, reference,
+                                               opts.alphabet,
+                                               opts.legacyzulu))))
+        if opts.decode:
+            return(int(bool(decodephonetic(args, outstream,
+                                           alphabet=opts.alphabet))))
+        workers = opts.jobs or cpucount()
+        if opts.files:
+            translatefiles(args, outstream, opts.alphabet, workers)
+            return(0)
+        for intext in args:
+            printphonetic(intext, outstream, opts.alphabet)
+        if opts.generate:
+            render = getalphabet(opts.alphabet).render
+            for passwords in generatepasswords(opts.generate, opts.length,
+                                               charset):
+                outstream.write(b''.join(map(render, passwords)))
+        elif not (args and sys.stdin.isatty()):
+            translatefiles([], outstream, opts.alphabet, workers)
+    except (IOError, OSError) as e:
+        sys.stderr.write(os.path.basename(argv[0] or 'ddpwprint') + ': ' +
+                         str(e) + '\n')
+        return(2)
+    finally:
+        outstream.flush()
+    return(0)
+
 
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(main(sys.argv))
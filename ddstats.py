@@ -27,9 +27,31 @@ If TESTRUN=1 and you are running this as a script,
 
 import sys
 import os
-import psutil
-import traceback
-from time import sleep
+import io
+import errno
+import importlib
+from time import sleep, time
+from collections import namedtuple, OrderedDict
+try:
+    from os import cpu_count
+except ImportError:
+    from multiprocessing import cpu_count
+from array import array
+from math import log, ceil
+import mmap
+import struct
+import re
+import threading
+import select
+import stat
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+from bisect import bisect_left, bisect_right
+import heapq
+from collections import deque
+from fnmatch import fnmatchcase
 
 from optparse import OptionParser
 
@@ -47,6 +69,36 @@ WIN32 = False
 if os.name == 'nt':
     WIN32 = True
 
+# Linux lets us skip psutil and read the hot counters straight from /proc
+LINUX = sys.platform.startswith('linux')
+FASTPATH = LINUX and os.access('/proc/stat', os.R_OK)
+if LINUX:
+    CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+
+class LazyModule(object):
+    '''Stands in for a module until one of its attributes is first used,
+    then imports it and puts the real module in its place.  A run that only
+    reads /proc never pays for importing psutil.
+    '''
+
+    def __init__(self, name):
+        self.lazyname = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.lazyname)
+        globals()[self.lazyname] = module
+        return(getattr(module, attr))
+
+
+psutil = LazyModule('psutil')
+json = LazyModule('json')
+socket = LazyModule('socket')
+
 
 def OUTPUT(outstring):
     '''Sends text to stdout with a carriage return.
@@ -77,79 +129,685 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Y', suffix)
 
 
-def totalcpu():
+def isnumber(value):
+    '''Returns True for ints and floats but not bools.
+    >>> isnumber(1.0), isnumber('1'), isnumber(True)
+    (True, False, False)
+    '''
+    return(isinstance(value, (int, float)) and not isinstance(value, bool))
+
+
+class ProcFile(object):
+    '''Keeps a /proc file open and rereads it from the top into one
+    preallocated buffer, so steady-state sampling neither reopens the file
+    nor allocates a new read buffer.  The buffer doubles when a read fills
+    it.  Reads are serialised, as collectors may run on several threads.
+    '''
+
+    def __init__(self, path, size=16384):
+        self.path = path
+        self.buffer = bytearray(size)
+        self.handle = io.open(path, 'rb', buffering=0)
+        self.lock = threading.Lock()
+
+    def read(self):
+        '''Returns the current contents of the file as a bytearray.'''
+        with self.lock:
+            self.handle.seek(0)
+            view = memoryview(self.buffer)
+            length = 0
+            while True:
+                n = self.handle.readinto(view[length:])
+                if not n:
+                    return(self.buffer[:length])
+                length += n
+                if length == len(self.buffer):
+                    # a bytearray cannot grow while a view of it is alive
+                    del view
+                    self.buffer.extend(bytearray(len(self.buffer)))
+                    view = memoryview(self.buffer)
+
+    def close(self):
+        self.handle.close()
+
+
+procfiles = {}
+
+
+def procread(path):
+    '''Returns the contents of a /proc file through a cached ProcFile.
+    >>> procread('/proc/stat').startswith(b'cpu')
+    True
+    '''
+    if path not in procfiles:
+        procfiles[path] = ProcFile(path)
+    return(procfiles[path].read())
+
+
+CpuTimes = namedtuple('CpuTimes', ['user', 'nice', 'system', 'idle',
+                                   'iowait', 'irq', 'softirq', 'steal',
+                                   'guest', 'guest_nice'])
+
+DiskIO = namedtuple('DiskIO', ['read_count', 'write_count', 'read_bytes',
+                               'write_bytes', 'read_time', 'write_time',
+                               'read_merged_count', 'write_merged_count',
+                               'busy_time'])
+
+
+def procstatcpu():
+    '''Returns a tuple of the total CpuTimes and a list of CpuTimes for
+    each CPU from /proc/stat, in seconds like psutil.cpu_times().
+    >>> isinstance(procstatcpu()[1], list)
+    True
+    '''
+    total = None
+    each = []
+    for line in procread('/proc/stat').splitlines():
+        if not line.startswith(b'cpu'):
+            break
+        fields = line.split()
+        times = [int(x) / CLOCK_TICKS for x in fields[1:11]]
+        times += [0.0] * (len(CpuTimes._fields) - len(times))
+        if fields[0] == b'cpu':
+            total = CpuTimes(*times)
+        else:
+            each.append(CpuTimes(*times))
+    return((total, each))
+
+
+wholedisks = {}
+
+
+def iswholedisk(name):
+    '''Returns True if name is a whole block device rather than a
+    partition, judged by its presence under /sys/block.  Answers are cached.
+    >>> iswholedisk('no-such-disk')
+    False
+    '''
+    if name not in wholedisks:
+        wholedisks[name] = os.path.exists('/sys/block/' +
+                                          name.replace('/', '!'))
+    return(wholedisks[name])
+
+
+def procdiskstats():
+    '''Returns a tuple of the total DiskIO over whole disks and a dictionary
+    of { 'N': DiskIO } for each device N in /proc/diskstats, matching
+    psutil.disk_io_counters().
+    >>> isinstance(procdiskstats()[1], dict)
+    True
+    '''
+    total = [0] * len(DiskIO._fields)
+    eachdisk = {}
+    for line in procread('/proc/diskstats').splitlines():
+        fields = line.split()
+        if len(fields) >= 14:
+            (reads, rmerged, rsectors, rtime, writes, wmerged, wsectors,
+             wtime, _, busy, _) = [int(x) for x in fields[3:14]]
+        elif len(fields) == 7:
+            reads, rsectors, writes, wsectors = [int(x) for x in fields[3:]]
+            rtime = wtime = rmerged = wmerged = busy = 0
+        else:
+            continue
+        name = fields[2].decode()
+        disk = DiskIO(reads, writes, rsectors * 512, wsectors * 512, rtime,
+                      wtime, rmerged, wmerged, busy)
+        eachdisk[name] = disk
+        if iswholedisk(name):
+            total = [x + y for x, y in zip(total, disk)]
+    return((DiskIO(*total), eachdisk))
+
+
+def procpids():
+    '''Returns a list of PIDs from the numeric entries of /proc.
+    >>> os.getpid() in procpids()
+    True
+    '''
+    return([int(x) for x in os.listdir('/proc') if x.isdigit()])
+
+
+def procfdcount(pid):
+    '''Returns the number of open fds of pid by scanning /proc/pid/fd.
+    Raises OSError if the process is gone or we may not look.
+    >>> procfdcount(os.getpid()) > 0
+    True
+    '''
+    path = '/proc/%d/fd' % pid
+    if scandir is None:
+        return(len(os.listdir(path)))
+    entries = scandir(path)
+    try:
+        return(sum(1 for _ in entries))
+    finally:
+        if hasattr(entries, 'close'):
+            entries.close()
+
+
+def fastproctable(attrs=['pid', 'num_fds']):
+    '''proctable() for Linux built straight from /proc.  Only pid and
+    num_fds are supported.  Processes that exit during the scan are left out
+    and fd counts we may not read are None.
+    >>> isinstance(fastproctable()[0], dict)
+    True
+    '''
+    outlist = []
+    for pid in procpids():
+        info = {'pid': pid}
+        if 'num_fds' in attrs:
+            try:
+                info['num_fds'] = procfdcount(pid)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ESRCH):
+                    continue
+                info['num_fds'] = None
+        outlist.append(info)
+    return(outlist)
+
+
+def cputimestotal(cputimes):
+    '''Returns a tuple of (busy, total) seconds from a psutil cpu_times()
+    entry.  Guest time is already counted in user and nice on Linux, so it is
+    left out of the total, and iowait counts as idle, the way psutil does it.
+    >>> busy, total = cputimestotal(psutil.cpu_times())
+    >>> busy <= total
+    True
+    '''
+    total = sum(cputimes)
+    total -= getattr(cputimes, 'guest', 0) + getattr(cputimes, 'guest_nice', 0)
+    idle = cputimes.idle + getattr(cputimes, 'iowait', 0)
+    return((total - idle, total))
+
+
+def cpupercent(cputimes1, cputimes2):
+    '''Returns a float percent of CPU utilization between two cpu_times()
+    entries.
+    >>> isinstance(cpupercent(psutil.cpu_times(), psutil.cpu_times()), float)
+    True
+    '''
+    busy1, total1 = cputimestotal(cputimes1)
+    busy2, total2 = cputimestotal(cputimes2)
+    if total2 <= total1:
+        return(0.0)
+    percent = 100.0 * (busy2 - busy1) / (total2 - total1)
+    return(round(min(max(percent, 0.0), 100.0), 1))
+
+
+def diskiocount(diskio):
+    '''Returns the number of transactions in a disk_io_counters() entry.
+    >>> isinstance(diskiocount(psutil.disk_io_counters(perdisk=False)), int)
+    True
+    '''
+    return(diskio.read_count + diskio.write_count)
+
+
+CgroupStat = namedtuple('CgroupStat', ['usage', 'throttled', 'memory',
+                                       'memorymax', 'rbytes', 'wbytes',
+                                       'rios', 'wios'])
+
+
+CGROUPIOFIELDS = {b'rbytes': 0, b'wbytes': 1, b'rios': 2, b'wios': 3}
+
+
+def cgroupmount():
+    '''Returns the mount point of the cgroup v2 hierarchy, or None if
+    there is none.
+    '''
+    try:
+        mounts = procread('/proc/mounts')
+    except (IOError, OSError):
+        return(None)
+    for line in mounts.splitlines():
+        fields = line.split()
+        if len(fields) > 2 and fields[2] == b'cgroup2':
+            return(fields[1].decode())
+    return(None)
+
+
+def cgroupdirs(root, depth=2):
+    '''Returns the cgroups under the cgroup v2 mount root down to depth
+    levels, as paths relative to root starting with /.
+    '''
+    cgroups = []
+    for dirpath, dirnames, _ in os.walk(root):
+        relative = os.path.relpath(dirpath, root)
+        if relative == '.':
+            cgroups.append('/')
+            level = 0
+        else:
+            cgroups.append('/' + relative)
+            level = relative.count(os.sep) + 1
+        if level >= depth:
+            del dirnames[:]
+    return(cgroups)
+
+
+def cgroupfile(path):
+    '''Returns the contents of a cgroup interface file through a cached
+    ProcFile, or None if the file or its cgroup is gone, in which case the
+    cached handle is closed.  cgroupsnapshot() closes the handles of
+    cgroups that are no longer walked.
+    '''
+    try:
+        return(procread(path))
+    except (IOError, OSError):
+        handle = procfiles.pop(path, None)
+        if handle is not None:
+            handle.close()
+        return(None)
+
+
+def cgroupstat(path):
+    '''Returns a CgroupStat of the CPU usage and throttled time in
+    microseconds, memory.current and memory.max in bytes, and IO bytes and
+    operations summed over devices for the cgroup directory path.  Figures
+    the cgroup does not expose, and an unlimited memory.max, are None.
+    '''
+    usage = throttled = memory = memorymax = None
+    io = [None] * 4
+    data = cgroupfile(path + '/cpu.stat')
+    if data is not None:
+        for line in data.splitlines():
+            key, _, value = line.partition(b' ')
+            if key == b'usage_usec':
+                usage = int(bytes(value))
+            elif key == b'throttled_usec':
+                throttled = int(bytes(value))
+    data = cgroupfile(path + '/memory.current')
+    if data:
+        memory = int(bytes(data))
+    data = cgroupfile(path + '/memory.max')
+    if data and not data.startswith(b'max'):
+        memorymax = int(bytes(data))
+    data = cgroupfile(path + '/io.stat')
+    if data is not None:
+        io = [0] * 4
+        for line in bytes(data).splitlines():
+            for field in line.split()[1:]:
+                key, _, value = field.partition(b'=')
+                if key in CGROUPIOFIELDS:
+                    io[CGROUPIOFIELDS[key]] += int(value)
+    return(CgroupStat(usage, throttled, memory, memorymax, *io))
+
+
+def cgroupsnapshot(root, depth=2):
+    '''Returns a dictionary of { 'N': CgroupStat } for each cgroup N under
+    root down to depth levels.  Cached handles of cgroups that are no longer
+    there are closed, so pod churn does not pile up open files.
+    '''
+    paths = dict((cgroup, os.path.join(root, cgroup.lstrip('/')))
+                 for cgroup in cgroupdirs(root, depth))
+    snapshot = dict((cgroup, cgroupstat(path))
+                    for cgroup, path in paths.items())
+    live = set(paths.values())
+    prefix = os.path.join(root, '')
+    for path in list(procfiles):
+        if path.startswith(prefix) and path.rsplit('/', 1)[0] not in live:
+            procfiles.pop(path).close()
+    return(snapshot)
+
+
+CGROUPSTATS = OrderedDict([('cgroupcpu', 'cpu%'),
+                           ('cgroupthrottled', 'throttled%'),
+                           ('cgroupmemory', 'mem'),
+                           ('cgroupmemorymax', 'max'),
+                           ('cgroupread', 'rB/s'), ('cgroupwrite', 'wB/s'),
+                           ('cgroupriops', 'r/s'), ('cgroupwiops', 'w/s')])
+
+
+def cgrouprates(stat1, stat2, interval):
+    '''Returns an ordered dictionary, keyed by the names in CGROUPSTATS, of
+    CPU use as a percent of one CPU, percent of the interval spent
+    throttled, memory in use and its limit, and IO bytes and operations per
+    second between two CgroupStat of one cgroup.  Figures the cgroup does
+    not expose are None.
+    '''
+    interval = float(interval)
+
+    def rate(field, scale=1.0):
+        before = getattr(stat1, field)
+        after = getattr(stat2, field)
+        if before is None or after is None or interval <= 0:
+            return(None)
+        return(scale * (after - before) / interval)
+
+    rates = OrderedDict()
+    rates['cgroupcpu'] = rate('usage', 1e-4)
+    rates['cgroupthrottled'] = rate('throttled', 1e-4)
+    rates['cgroupmemory'] = stat2.memory
+    rates['cgroupmemorymax'] = stat2.memorymax
+    rates['cgroupread'] = rate('rbytes')
+    rates['cgroupwrite'] = rate('wbytes')
+    rates['cgroupriops'] = rate('rios')
+    rates['cgroupwiops'] = rate('wios')
+    return(rates)
+
+
+PRESSUREFS = '/proc/pressure'
+PRESSURESTATS = OrderedDict([('pressure', 'some'), ('pressurefull', 'full'),
+                             ('pressureevent', 'triggered')])
+
+
+def pressuretrigger(spec):
+    '''Splits a trigger such as 'memory some 150000 2000000' into the PSI
+    resource and the line the kernel expects: some or full, then the stall
+    and the window in microseconds.
+    >>> pressuretrigger('cpu some 150000 2000000')
+    ('cpu', 'some 150000 2000000')
+    '''
+    fields = spec.split()
+    if (len(fields) != 4 or fields[0] not in ('cpu', 'memory', 'io') or
+            fields[1] not in ('some', 'full') or
+            not fields[2].isdigit() or not fields[3].isdigit()):
+        raise ValueError('pressure trigger should look like ' +
+                         '"memory some 150000 2000000", not ' + repr(spec))
+    return((fields[0], ' '.join(fields[1:])))
+
+
+def pressurestats(root=PRESSUREFS):
+    '''Returns a dictionary of { 'N': (some, full) } 10 second stall
+    averages in percent for each PSI resource N under root.  A resource
+    without a full line has None there, and anything that is not a regular
+    file, such as a test pipe, is skipped.
+    '''
+    stats = {}
+    for resource in ('cpu', 'memory', 'io'):
+        path = os.path.join(root, resource)
+        if not os.path.isfile(path):
+            continue
+        averages = {}
+        try:
+            data = procread(path)
+        except (IOError, OSError):
+            continue
+        for line in bytes(data).splitlines():
+            fields = line.split()
+            if fields and fields[1].startswith(b'avg10='):
+                averages[fields[0]] = float(fields[1][6:])
+        stats[resource] = (averages.get(b'some'), averages.get(b'full'))
+    return(stats)
+
+
+def iterpressure(triggers, sample_interval=5, count=None, cgroups=None,
+                 root=PRESSUREFS):
+    '''Generator that registers every (resource, trigger) pair from
+    pressuretrigger() with the kernel and blocks in poll() until one fires,
+    then yields a samplerates() dictionary over the following
+    sample_interval, with the resources that fired under 'pressure'.  It
+    never wakes up otherwise.  A FIFO in place of a pressure file is taken
+    as a test stand-in that fires whenever something is written to it.
+    '''
+    poller = select.poll()
+    resources = {}
+    fifos = set()
+    try:
+        for resource, trigger in triggers:
+            path = os.path.join(root, resource)
+            fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+            resources[fd] = resource
+            if stat.S_ISFIFO(os.fstat(fd).st_mode):
+                fifos.add(fd)
+            else:
+                try:
+                    os.write(fd, trigger.encode('ascii') + b'\0')
+                except OSError as e:
+                    raise RuntimeError('%s refused trigger "%s": %s' %
+                                       (path, trigger, e.strerror))
+            poller.register(fd, select.POLLPRI | select.POLLIN)
+        ticks = 0
+        while count is None or ticks < count:
+            fired = set()
+            for fd, event in poller.poll():
+                if event & (select.POLLERR | select.POLLNVAL):
+                    raise RuntimeError('pressure trigger on ' +
+                                       resources[fd] + ' failed')
+                if fd in fifos:
+                    os.read(fd, 65536)
+                fired.add(resources[fd])
+            rates = next(itersamples(sample_interval, 1, cgroups))
+            rates['pressure'] = sorted(fired)
+            yield rates
+            ticks += 1
+    finally:
+        for fd in resources:
+            os.close(fd)
+
+
+Snapshot = namedtuple('Snapshot', ['time', 'cpu', 'eachcpu', 'diskio',
+                                   'eachdiskio', 'cgroups'])
+
+
+def snapshot(cgroups=None):
+    '''Returns a Snapshot of every counter the rate metrics are computed
+    from, taken back to back.  Missing counters (no disks, say) are None.
+    Given a tuple of a cgroup v2 mount and a depth, it also holds a
+    cgroupsnapshot() of that hierarchy.
+    >>> isinstance(snapshot().eachcpu, list)
+    True
+    '''
+    cgroupstats = None
+    if cgroups is not None:
+        cgroupstats = cgroupsnapshot(*cgroups)
+    if FASTPATH:
+        try:
+            cpu, eachcpu = procstatcpu()
+            diskio, eachdisk = procdiskstats()
+            return(Snapshot(time(), cpu, eachcpu, diskio, eachdisk,
+                            cgroupstats))
+        except (IOError, OSError):
+            pass
+    try:
+        diskio = psutil.disk_io_counters(perdisk=False)
+        eachdisk = psutil.disk_io_counters(perdisk=True)
+    except:
+        diskio = None
+        eachdisk = None
+    return(Snapshot(time(), psutil.cpu_times(False), psutil.cpu_times(True),
+                    diskio, eachdisk, cgroupstats))
+
+
+def samplerates(snap1, snap2):
+    '''Computes every rate metric from one pair of snapshots.  Returns a
+    dictionary with totalcpu, eachcpu, totaldiskio and eachdiskio keys, the
+    time of the closing snapshot, and the snapshots themselves for figures
+    that are only worked out on demand, like diskrates().
+    Disks that appear or vanish between the snapshots are left out.
+    >>> sorted(samplerates(snapshot(), snapshot()).keys())
+    ['eachcpu', 'eachdiskio', 'snapshots', 'time', 'totalcpu', 'totaldiskio']
+    '''
+    interval = snap2.time - snap1.time
+    rates = {'time': snap2.time,
+             'snapshots': (snap1, snap2),
+             'totalcpu': cpupercent(snap1.cpu, snap2.cpu),
+             'eachcpu': [cpupercent(c1, c2) for c1, c2 in
+                         zip(snap1.eachcpu, snap2.eachcpu)],
+             'totaldiskio': None,
+             'eachdiskio': None}
+    if interval <= 0:
+        interval = float('inf')
+    if snap1.diskio and snap2.diskio:
+        t = diskiocount(snap2.diskio) - diskiocount(snap1.diskio)
+        rates['totaldiskio'] = float(t)/interval
+    if snap1.eachdiskio is not None and snap2.eachdiskio is not None:
+        rates['eachdiskio'] = {}
+        for disk in snap2.eachdiskio.keys():
+            if disk not in snap1.eachdiskio:
+                continue
+            t = (diskiocount(snap2.eachdiskio[disk]) -
+                 diskiocount(snap1.eachdiskio[disk]))
+            rates['eachdiskio'].update({disk: float(t)/interval})
+    return(rates)
+
+
+DISKSTATS = OrderedDict([('diskread', 'r/s'), ('diskwrite', 'w/s'),
+                         ('diskreadbytes', 'rB/s'),
+                         ('diskwritebytes', 'wB/s'),
+                         ('diskutil', 'util%'), ('diskawait', 'await_ms')])
+VIRTUALDISKS = re.compile('^(dm-|loop|ram|zram)')
+
+
+def diskrates(disk1, disk2, interval):
+    '''Returns an ordered dictionary of read and write IOPS, read and
+    write bytes per second, percent utilization and average wait in
+    milliseconds per transaction between two disk_io_counters() entries for
+    one device, keyed by the names in DISKSTATS.  Utilization needs
+    busy_time, which not every platform has, and is None without it.
+    >>> list(diskrates(DiskIO(*[0] * 9), DiskIO(*[10] * 9), 1).values())
+    [10.0, 10.0, 10.0, 10.0, 1.0, 1.0]
+    '''
+    interval = float(interval)
+    reads = disk2.read_count - disk1.read_count
+    writes = disk2.write_count - disk1.write_count
+    waited = (disk2.read_time - disk1.read_time +
+              disk2.write_time - disk1.write_time)
+    busy = None
+    if hasattr(disk2, 'busy_time') and interval > 0:
+        busy = disk2.busy_time - disk1.busy_time
+        busy = min(100.0, 100.0 * busy / (interval * 1000))
+    rates = OrderedDict()
+    rates['diskread'] = reads / interval
+    rates['diskwrite'] = writes / interval
+    rates['diskreadbytes'] = (disk2.read_bytes - disk1.read_bytes) / interval
+    rates['diskwritebytes'] = ((disk2.write_bytes - disk1.write_bytes) /
+                               interval)
+    rates['diskutil'] = busy
+    rates['diskawait'] = (reads + writes) and float(waited) / (reads +
+                                                               writes) or 0.0
+    return(rates)
+
+
+def diskselected(opts, name):
+    '''Returns True if per-device disk IO for name passes the --disks,
+    --novirtual and --nopartitions filters in opts.
+    '''
+    if not name:
+        return(True)
+    if opts.disks and not re.search(opts.disks, name):
+        return(False)
+    if opts.novirtual and VIRTUALDISKS.search(name):
+        return(False)
+    if opts.nopartitions and LINUX and not iswholedisk(name):
+        return(False)
+    return(True)
+
+
+def itersamples(sample_interval=5, count=None, cgroups=None):
+    '''Generator yielding the samplerates() dictionary once per
+    sample_interval seconds, forever or for count samples.  Each tick reuses
+    the previous tick's closing snapshot as its opening one, so counters are
+    read once per tick and the rates are deltas between consecutive ticks.
+    Ticks are scheduled against a fixed deadline so collection time does not
+    accumulate as drift.  cgroups is passed on to snapshot().
+    >>> len(list(itersamples(0.01, 2)))
+    2
+    '''
+    snap1 = snapshot(cgroups)
+    deadline = snap1.time
+    ticks = 0
+    while count is None or ticks < count:
+        deadline += sample_interval
+        now = time()
+        if deadline > now:
+            sleep(deadline - now)
+        else:
+            deadline = now
+        snap2 = snapshot(cgroups)
+        yield samplerates(snap1, snap2)
+        snap1 = snap2
+        ticks += 1
+
+
+def sampledrates(sample_interval=5):
+    '''Takes a sample_interval in seconds and returns the samplerates()
+    dictionary for one window of that length.  Every rate metric shares the
+    same pair of snapshots, so this sleeps once no matter how many are used.
+    >>> isinstance(sampledrates(0.01)['totalcpu'], float)
+    True
+    '''
+    return(next(itersamples(sample_interval, 1)))
+
+
+def totalcpu(sample_interval=1):
     '''Returns a float percent of CPU utilization from a one-second
     snapshot.
-    >>> type(totalcpu())
-    <type 'float'>
+    >>> isinstance(totalcpu(), float)
+    True
     '''
-    return(psutil.cpu_percent(1, False))
+    return(sampledrates(sample_interval)['totalcpu'])
 
 
-def eachcpu():
+def eachcpu(sample_interval=1):
     '''Returns a list CPU utilization percentages for each CPU in order.
-    >>> type(eachcpu())
-    <type 'list'>
+    >>> isinstance(eachcpu(), list)
+    True
+    '''
+    return(sampledrates(sample_interval)['eachcpu'])
+
+
+RamUsage = namedtuple('RamUsage', ['total', 'available', 'percent'])
+
+
+def virtualmemory():
+    '''Returns a RamUsage of total and available bytes and percent used,
+    read from /proc/meminfo on the fast path the way psutil.virtual_memory()
+    figures them, and from psutil elsewhere or on kernels older than 3.14.
+    >>> 0 <= virtualmemory().percent <= 100
+    True
     '''
-    return(psutil.cpu_percent(1, True))
+    if FASTPATH:
+        fields = {}
+        for line in bytes(procread('/proc/meminfo')).splitlines():
+            name, _, value = line.partition(b':')
+            fields[name] = value
+        if b'MemAvailable' in fields:
+            total = int(fields[b'MemTotal'].split()[0]) * 1024
+            available = int(fields[b'MemAvailable'].split()[0]) * 1024
+            percent = round((total - available) * 100.0 / total, 1)
+            return(RamUsage(total, available, percent))
+    ram = psutil.virtual_memory()
+    return(RamUsage(ram.total, ram.available, ram.percent))
 
 
 def ramused():
     '''Returns a float percent of RAM utilization.
-    >>> type(ramused())
-    <type 'float'>
+    >>> isinstance(ramused(), float)
+    True
     '''
-    return(psutil.virtual_memory().percent)
+    return(virtualmemory().percent)
 
 
 def ramratio():
     '''Returns an array ['x', 'y'] of x memory in use and y total memory.
-    >>> type(ramratio())
-    <type 'list'>
+    >>> isinstance(ramratio(), list)
+    True
     '''
-    ram = psutil.virtual_memory()
+    ram = virtualmemory()
     return([sizeof_fmt(ram.total - ram.available), sizeof_fmt(ram.total)])
 
 
 def totaldiskio(sample_interval=5):
     '''Takes a sample_interval in seconds and returns transactions per second.
     This includes reads and writes from all disks.
-    >>> type(totaldiskio(0.01))
-    <type 'float'>
+    >>> isinstance(totaldiskio(0.01), float)
+    True
     '''
-    diskio1 = psutil.disk_io_counters(perdisk=False)
-    sleep(sample_interval)
-    diskio2 = psutil.disk_io_counters(perdisk=False)
-    t = (diskio2.read_count + diskio2.write_count - diskio1.read_count -
-         diskio1.write_count)
-    return(float(t)/float(sample_interval))
+    return(sampledrates(sample_interval)['totaldiskio'])
 
 
 def eachdiskio(sample_interval=5):
     '''Returns a dictionary of { 'N': x } for each disk N and x transactions
     per second.
-    >>> type(eachdiskio(0.01))
-    <type 'dict'>
-    '''
-    outdict = {}
-    diskio1 = psutil.disk_io_counters(perdisk=True)
-    sleep(sample_interval)
-    diskio2 = psutil.disk_io_counters(perdisk=True)
-    if diskio1.keys() != diskio2.keys():
-        return(None)
-    for disk in diskio2.keys():
-        t = (diskio2[disk].read_count + diskio2[disk].write_count -
-             diskio1[disk].read_count - diskio1[disk].write_count)
-        outdict.update({disk: float(t)/float(sample_interval)})
-    return(outdict)
+    >>> isinstance(eachdiskio(0.01), dict)
+    True
+    '''
+    return(sampledrates(sample_interval)['eachdiskio'])
 
 
 def fetchdiskspace(partitionobject):
     '''Gets the disk usage from an object returned by psutil.disk_partition().
     It returns a key-value pair of the partition name and its percentage of use
     or the last exception thrown in the attempt.
-    >>> type(fetchdiskspace(psutil.disk_partitions()[0]))
-    <type 'dict'>
+    >>> isinstance(fetchdiskspace(psutil.disk_partitions()[0]), dict)
+    True
     '''
     try:
         k = partitionobject.device
@@ -162,53 +820,229 @@ def fetchdiskspace(partitionobject):
     return({k: v})
 
 
-def eachdiskspace():
+DISKWORKERS = 8
+DISKTIMEOUT = 2.0
+DISKBACKOFF = 300
+diskpool = None
+diskjobs = {}
+diskbackoff = {}
+
+
+class DeadlineJob(object):
+    '''One call handed to a DeadlinePool, with its result or exception.'''
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.result = None
+        self.error = None
+        self.started = False
+        self.done = threading.Event()
+
+    def run(self):
+        self.started = True
+        try:
+            self.result = self.function(*self.args)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def wait(self, deadline):
+        '''Waits until the UNIX time deadline at the latest, or for as long
+        as it takes if deadline is None, and returns True if the job
+        finished.'''
+        if deadline is None:
+            self.done.wait()
+        else:
+            self.done.wait(max(deadline - time(), 0))
+        return(self.done.is_set())
+
+
+class DeadlinePool(object):
+    '''Fixed set of daemon worker threads for calls that may never return,
+    such as statvfs on a dead NFS mount.  Callers wait for each job only up
+    to a deadline.  A stuck worker stays stuck, but it holds up neither the
+    caller nor interpreter exit.
+    '''
+
+    def __init__(self, workers):
+        self.queue = Queue()
+        for _ in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def work(self):
+        while True:
+            self.queue.get().run()
+
+    def submit(self, function, *args):
+        job = DeadlineJob(function, args)
+        self.queue.put(job)
+        return(job)
+
+
+def eachdiskspace(timeout=DISKTIMEOUT):
     '''Returns a dictionary of { 'N': x } for each device N and x percent of
-    disk consumed, eliminating redundancies.
-    >>> type(eachdiskspace())
-    <type 'dict'>
+    disk consumed, eliminating redundancies.  Mounts are queried in parallel
+    on a DeadlinePool.  One that does not answer within timeout seconds is
+    reported as 'timeout' and left alone for DISKBACKOFF seconds, or for as
+    long as its earlier query is still stuck.
+    >>> isinstance(eachdiskspace(), dict)
+    True
     '''
+    global diskpool
+    if diskpool is None:
+        diskpool = DeadlinePool(DISKWORKERS)
     diskdict = {}
-    map(lambda x: diskdict.update(fetchdiskspace(x)), psutil.disk_partitions())
+    jobs = []
+    now = time()
+    deadline = now + timeout
+    for partition in psutil.disk_partitions():
+        mount = partition.mountpoint
+        job = diskjobs.get(mount)
+        if job is not None and not job.done.is_set():
+            diskbackoff[mount] = now + DISKBACKOFF
+            jobs.append((partition, None))
+        elif diskbackoff.get(mount, 0) > now:
+            jobs.append((partition, None))
+        else:
+            diskjobs[mount] = diskpool.submit(fetchdiskspace, partition)
+            jobs.append((partition, diskjobs[mount]))
+    for partition, job in jobs:
+        if job is not None and job.wait(deadline):
+            diskdict.update(job.result)
+            diskbackoff.pop(partition.mountpoint, None)
+            continue
+        if job is not None and job.started:
+            diskbackoff[partition.mountpoint] = now + DISKBACKOFF
+        diskdict.update({partition.device: 'timeout'})
     return(diskdict)
 
 
-def processcount():
-    '''Returns number of running processes.
-    >>> type(processcount())
-    <type 'int'>
+def processcount(processlist=[]):
+    '''Returns number of running processes, or the length of processlist
+    if one was already collected.
+    >>> isinstance(processcount(), int)
+    True
     '''
+    if processlist:
+        return(len(processlist))
+    if FASTPATH:
+        return(len(procpids()))
     return(len(psutil.pids()))
 
 
+def procfield(process, field):
+    '''Returns field from either a proctable() dictionary or a bare
+    psutil.Process, so older callers passing psaux() lists keep working.
+    >>> procfield({'name': 'init'}, 'name')
+    'init'
+    '''
+    if isinstance(process, dict):
+        return(process.get(field))
+    value = getattr(process, field)
+    if callable(value):
+        value = value()
+    return(value)
+
+
 def uniqueprocesscount(processlist=[]):
     '''Returns number of unique process names.
-    >>> type(uniqueprocesscount())
-    <type 'int'>
+    >>> isinstance(uniqueprocesscount(), int)
+    True
     '''
     if not processlist:
-        processlist = psaux()
-    unique_procs = len(set(map(lambda x: x.name(), processlist)))
+        processlist = proctable()
+    unique_procs = len(set(procfield(x, 'name') for x in processlist))
     return(unique_procs)
 
 
 def fhcount(processlist=[]):
-    '''Returns number of unique process names.
-    >>> type(fhcount())
-    <type 'int'>
+    '''Returns number of open file handles across all processes.  Without
+    a processlist this is the handles figure of fhcensus().
+    >>> isinstance(fhcount(), int)
+    True
     '''
     if not processlist:
-        processlist = psaux()
+        census = fhcensus()
+        if not census.counted:
+            return('Unknown.  Maybe you need more privileges.')
+        return(census.handles)
     try:
         if WIN32:
-            fhcounter = sum(map(lambda x: x.num_handles(), processlist))
+            counts = [procfield(x, 'num_handles') for x in processlist]
         else:
-            fhcounter = sum(map(lambda x: x.num_fds(), processlist))
+            counts = [procfield(x, 'num_fds') for x in processlist]
+        fhcounter = sum(counts)
     except:
+        # a None from proctable() means access was denied, as does a raise
         fhcounter = 'Unknown.  Maybe you need more privileges.'
     return(fhcounter)
 
 
+FdCensus = namedtuple('FdCensus', ['handles', 'counted', 'skipped'])
+
+FDCHUNK = 256
+try:
+    FDWORKERS = min(32, (cpu_count() or 0) + 4)
+except NotImplementedError:
+    FDWORKERS = 4
+fdpool = None
+
+
+def fdcountchunk(pids):
+    '''Counts the open handles of every PID in pids.  Returns an FdCensus
+    for the chunk, where processes we may not inspect are skipped and those
+    that exited in the meantime are left out altogether.
+    >>> fdcountchunk([os.getpid()]).counted
+    1
+    '''
+    handles = counted = skipped = 0
+    for pid in pids:
+        try:
+            if FASTPATH:
+                handles += procfdcount(pid)
+            elif WIN32:
+                handles += psutil.Process(pid).num_handles()
+            else:
+                handles += psutil.Process(pid).num_fds()
+            counted += 1
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ESRCH):
+                skipped += 1
+        except psutil.NoSuchProcess:
+            pass
+        except psutil.Error:
+            skipped += 1
+    return(FdCensus(handles, counted, skipped))
+
+
+def fhcensus(pids=None, workers=FDWORKERS, chunksize=FDCHUNK):
+    '''Counts open file handles across pids, or every process, in chunks
+    of chunksize PIDs spread over a pool of worker threads.  Returns an
+    FdCensus of the total handles with the number of processes counted and
+    skipped for lack of privileges.
+    >>> fhcensus([os.getpid()], 1).counted
+    1
+    '''
+    global fdpool
+    if pids is None:
+        if FASTPATH:
+            pids = procpids()
+        else:
+            pids = psutil.pids()
+    chunks = [pids[x:x + chunksize] for x in range(0, len(pids), chunksize)]
+    if workers <= 1 or len(chunks) <= 1:
+        results = [fdcountchunk(x) for x in chunks]
+    else:
+        if fdpool is None:
+            from multiprocessing.pool import ThreadPool
+            fdpool = ThreadPool(workers)
+        results = fdpool.map(fdcountchunk, chunks)
+    return(FdCensus(*[sum(x) for x in zip(FdCensus(0, 0, 0), *results)]))
+
+
 def psaux():
     '''Get process list by either new or old means.  This is for backward
     compatibility to old or <gasp>Win32</gasp> versions of psutil.
@@ -225,6 +1059,1479 @@ def psaux():
     return(outlist)
 
 
+if WIN32:
+    PROCATTRS = ['pid', 'name', 'num_handles']
+else:
+    PROCATTRS = ['pid', 'name', 'num_fds']
+
+
+TOPSORTS = ['cpu', 'rss', 'io', 'fds']
+processtracker = None
+
+
+class ProcessTracker(object):
+    '''Keeps a psutil.Process for every process across ticks, keyed by PID
+    and checked against its create_time, so cpu_percent() and IO deltas
+    come out as increments since the last tick without sleeping per
+    process.  New and exited processes are found by diffing PID sets.
+    '''
+
+    def __init__(self):
+        self.processes = {}
+        self.created = {}
+        self.iobytes = {}
+        self.lastrank = None
+
+    def refresh(self):
+        '''Drops exited processes and starts tracking new ones.'''
+        if FASTPATH:
+            pids = set(procpids())
+        else:
+            pids = set(psutil.pids())
+        for pid in set(self.processes) - pids:
+            self.forget(pid)
+        for pid in pids - set(self.processes):
+            self.track(pid)
+
+    def track(self, pid):
+        try:
+            process = psutil.Process(pid)
+            self.created[pid] = process.create_time()
+            process.cpu_percent(None)
+            self.processes[pid] = process
+        except psutil.Error:
+            self.forget(pid)
+
+    def forget(self, pid):
+        self.processes.pop(pid, None)
+        self.created.pop(pid, None)
+        self.iobytes.pop(pid, None)
+
+    def measure(self, pid, sort, interval):
+        '''Returns a tuple of the sort figure and name of pid, or None if it
+        cannot be read or has no figure yet.'''
+        process = self.processes[pid]
+        with process.oneshot():
+            if process.create_time() != self.created[pid]:
+                # the PID was reused; start over with the new process
+                self.forget(pid)
+                self.track(pid)
+                return(None)
+            name = process.name()
+            if sort == 'cpu':
+                value = process.cpu_percent(None)
+            elif sort == 'rss':
+                value = process.memory_info().rss
+            elif sort == 'fds':
+                if WIN32:
+                    value = process.num_handles()
+                else:
+                    value = process.num_fds()
+            else:
+                io = process.io_counters()
+                total = io.read_bytes + io.write_bytes
+                last = self.iobytes.get(pid)
+                self.iobytes[pid] = total
+                if last is None or not interval:
+                    return(None)
+                value = (total - last) / interval
+        return((value, name))
+
+    def rank(self, n, sort='cpu'):
+        '''Returns a list of up to n (value, pid, name) tuples for the
+        hottest processes by sort, which is one of TOPSORTS, highest first.
+        Only the top n are kept while scanning, on a heap.
+        '''
+        self.refresh()
+        now = time()
+        interval = None
+        if self.lastrank is not None:
+            interval = now - self.lastrank
+        self.lastrank = now
+        measured = []
+        for pid in list(self.processes):
+            try:
+                figure = self.measure(pid, sort, interval)
+            except psutil.NoSuchProcess:
+                self.forget(pid)
+                continue
+            except psutil.Error:
+                continue
+            if figure is not None:
+                measured.append((figure[0], pid, figure[1]))
+        return(heapq.nlargest(n, measured))
+
+
+def trackprocesses():
+    '''Returns the shared ProcessTracker, creating it on first use.'''
+    global processtracker
+    if processtracker is None:
+        processtracker = ProcessTracker()
+        processtracker.refresh()
+    return(processtracker)
+
+
+def proctable(attrs=PROCATTRS):
+    '''Returns a list of dictionaries, one per process, holding every
+    field in attrs.  Each process is read in one pass, so callers share a
+    single walk of the process table.  Processes that exit during the scan
+    are left out, and fields we may not read are None.
+    >>> isinstance(proctable()[0], dict)
+    True
+    '''
+    if FASTPATH and set(attrs) <= set(['pid', 'num_fds']):
+        try:
+            return(fastproctable(attrs))
+        except (IOError, OSError):
+            pass
+    try:
+        return([x.info for x in psutil.process_iter(attrs=attrs,
+                                                     ad_value=None)])
+    except TypeError:
+        pass
+    # psutil before 5.3 has no attrs, so gather them by hand
+    outlist = []
+    for process in psaux():
+        info = {}
+        try:
+            for field in attrs:
+                try:
+                    info[field] = procfield(process, field)
+                except psutil.AccessDenied:
+                    info[field] = None
+        except psutil.NoSuchProcess:
+            continue
+        outlist.append(info)
+    return(outlist)
+
+
+try:
+    from time import process_time
+except ImportError:
+    def process_time():
+        '''Returns the CPU seconds of this process, for Pythons before 3.3.
+        '''
+        times = os.times()
+        return(times[0] + times[1])
+
+SELFSTATS = OrderedDict([('selfwall', 'wall_ms'), ('selfcpu', 'cpu_ms'),
+                         ('selfsyscalls', 'syscalls'), ('selfprocs', 'procs'),
+                         ('selfload', 'load%')])
+SelfCounters = namedtuple('SelfCounters', ['wall', 'cpu', 'syscalls',
+                                           'procs'])
+procsscanned = 0
+scanlock = threading.Lock()
+selfbaseline = None
+selflast = SelfCounters(time(), process_time(), None, 0)
+
+
+def countscanned(n):
+    '''Adds n to the processes collectors have scanned, for --selfstats.'''
+    global procsscanned
+    with scanlock:
+        procsscanned += n
+
+
+def syscallcount():
+    '''Returns the read and write class system calls this process has made
+    so far, from /proc/self/io, or None where that cannot be read.
+    >>> syscallcount() is None or syscallcount() > 0
+    True
+    '''
+    if not LINUX:
+        return(None)
+    try:
+        data = bytes(procread('/proc/self/io'))
+    except (IOError, OSError):
+        return(None)
+    count = 0
+    for line in data.splitlines():
+        if line.startswith((b'syscr:', b'syscw:')):
+            count += int(line.split()[1])
+    return(count)
+
+
+def selfcounters():
+    '''Returns the SelfCounters of this process so far: wall and CPU
+    seconds, system calls and processes scanned.  The first call also
+    measures the system calls a reading costs, for selfcost() to discount.
+    '''
+    global selfbaseline
+    if selfbaseline is None:
+        first = syscallcount()
+        selfbaseline = 0 if first is None else syscallcount() - first
+    return(SelfCounters(time(), process_time(), syscallcount(),
+                        procsscanned))
+
+
+def selfcost(before, after, readings=0):
+    '''Returns an ordered dictionary of the SELFSTATS figures between two
+    selfcounters() readings, less the system calls of reading them and of
+    any further readings taken in between.
+    '''
+    syscalls = None
+    if before.syscalls is not None and after.syscalls is not None:
+        syscalls = max(after.syscalls - before.syscalls -
+                       selfbaseline * (readings + 1), 0)
+    return(OrderedDict([('selfwall', (after.wall - before.wall) * 1000),
+                        ('selfcpu', (after.cpu - before.cpu) * 1000),
+                        ('selfsyscalls', syscalls),
+                        ('selfprocs', after.procs - before.procs)]))
+
+
+ROLLUPWINDOWS = OrderedDict([('1m', 60), ('5m', 300), ('15m', 900)])
+ROLLUPFLOOR = 0.001
+ROLLUPBASE = log(1.04)
+ROLLUPBUCKETS = 1 + int(ceil(log(1e15 / ROLLUPFLOOR) / ROLLUPBASE))
+
+
+def rollupbucket(value):
+    '''Returns the histogram bucket for value.  Buckets grow geometrically
+    by 4%, so percentiles read from them are within 2% of the true value.
+    >>> rollupbucket(0)
+    0
+    '''
+    if value <= ROLLUPFLOOR:
+        return(0)
+    return(min(1 + int(log(value / ROLLUPFLOOR) / ROLLUPBASE),
+               ROLLUPBUCKETS - 1))
+
+
+class MonotonicQueue(object):
+    '''Sequence numbers of a RingSeries kept in an array('l') ring, with
+    values increasing from the front for a minimum or decreasing for a
+    maximum.  The front is always the extreme of the window.
+    '''
+
+    def __init__(self, series, maximum=False):
+        self.series = series
+        self.maximum = maximum
+        self.seqs = array('l', [0]) * series.capacity
+        self.head = 0
+        self.tail = 0
+
+    def value(self, seq):
+        return(self.series.values[seq % self.series.capacity])
+
+    def push(self, seq):
+        '''Adds seq, dropping queued entries it makes irrelevant.'''
+        value = self.value(seq)
+        capacity = self.series.capacity
+        while self.tail > self.head:
+            back = self.value(self.seqs[(self.tail - 1) % capacity])
+            if (back > value) if not self.maximum else (back < value):
+                self.tail -= 1
+            else:
+                break
+        self.seqs[self.tail % capacity] = seq
+        self.tail += 1
+
+    def expire(self, seq):
+        '''Drops the front entry if it is seq.'''
+        if (self.tail > self.head and
+                self.seqs[self.head % self.series.capacity] == seq):
+            self.head += 1
+
+    def front(self):
+        return(self.value(self.seqs[self.head % self.series.capacity]))
+
+
+class Rollup(object):
+    '''Running count, sum, minimum, maximum and histogram of the samples of
+    a RingSeries that fall inside the last seconds seconds.  Adding or
+    expiring a sample is O(1).
+    '''
+
+    def __init__(self, series, seconds):
+        self.series = series
+        self.seconds = seconds
+        self.first = 0
+        self.count = 0
+        self.total = 0.0
+        self.histogram = array('l', [0]) * ROLLUPBUCKETS
+        self.minimum = MonotonicQueue(series)
+        self.maximum = MonotonicQueue(series, True)
+
+    def add(self, seq, value):
+        self.count += 1
+        self.total += value
+        self.histogram[rollupbucket(value)] += 1
+        self.minimum.push(seq)
+        self.maximum.push(seq)
+
+    def expire(self, now, nextseq):
+        '''Drops samples older than the window, and the one nextseq is
+        about to overwrite in the ring.'''
+        series = self.series
+        while self.first < nextseq:
+            slot = self.first % series.capacity
+            if (series.times[slot] > now - self.seconds and
+                    self.first > nextseq - series.capacity):
+                break
+            value = series.values[slot]
+            self.count -= 1
+            self.total -= value
+            self.histogram[rollupbucket(value)] -= 1
+            self.minimum.expire(self.first)
+            self.maximum.expire(self.first)
+            self.first += 1
+        if not self.count:
+            self.total = 0.0
+
+    def percentile(self, percent):
+        '''Returns the approximate percent percentile of the window, read
+        off the histogram and clamped to the exact minimum and maximum.'''
+        rank = max(1, int(ceil(self.count * percent / 100.0)))
+        seen = 0
+        for bucket, hits in enumerate(self.histogram):
+            seen += hits
+            if seen >= rank:
+                break
+        if bucket:
+            value = ROLLUPFLOOR * (1.04 ** (bucket - 0.5))
+        else:
+            value = 0.0
+        return(min(max(value, self.minimum.front()), self.maximum.front()))
+
+    def summary(self):
+        '''Returns an ordered dictionary of count, min, mean, max, p50, p95
+        and p99, or None if the window is empty.'''
+        if not self.count:
+            return(None)
+        return(OrderedDict([('count', self.count),
+                            ('min', self.minimum.front()),
+                            ('mean', self.total / self.count),
+                            ('max', self.maximum.front()),
+                            ('p50', self.percentile(50)),
+                            ('p95', self.percentile(95)),
+                            ('p99', self.percentile(99))]))
+
+
+class RingSeries(object):
+    '''Fixed-size ring buffer of sample times and values for one metric,
+    held in array('d') so no Python object is kept per sample, with one
+    Rollup per window in ROLLUPWINDOWS.
+    >>> series = RingSeries(4)
+    >>> for t in range(6): series.append(t, t * 10)
+    >>> series.rollups['1m'].summary()['min']
+    20.0
+    '''
+
+    def __init__(self, capacity, windows=ROLLUPWINDOWS):
+        self.capacity = capacity
+        self.times = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        self.added = 0
+        self.rollups = OrderedDict((name, Rollup(self, seconds))
+                                   for name, seconds in windows.items())
+
+    def append(self, when, value):
+        seq = self.added
+        for rollup in self.rollups.values():
+            rollup.expire(when, seq)
+        slot = seq % self.capacity
+        self.times[slot] = when
+        self.values[slot] = value
+        self.added += 1
+        for rollup in self.rollups.values():
+            rollup.add(seq, value)
+
+
+class MetricStore(object):
+    '''In-memory time series store for a long-running ddstats.  Every
+    numeric metric of each recorded sample gets its own RingSeries, sized to
+    hold the longest rollup window at the given sample_interval.
+    >>> store = MetricStore(1)
+    >>> store.record({'cpu': 50.0}, 0)
+    >>> store.summary('cpu', '5m')['max']
+    50.0
+    '''
+
+    def __init__(self, sample_interval, windows=ROLLUPWINDOWS):
+        self.windows = windows
+        self.capacity = 1 + int(ceil(max(windows.values()) /
+                                     float(max(sample_interval, 0.001))))
+        self.series = OrderedDict()
+
+    def record(self, sample, when):
+        '''Appends every numeric value of a collectsample() dictionary.'''
+        for key, value in sample.items():
+            if not isnumber(value):
+                continue
+            if key not in self.series:
+                self.series[key] = RingSeries(self.capacity, self.windows)
+            self.series[key].append(when, value)
+
+    def summary(self, key, window):
+        '''Returns the Rollup.summary() of metric key over window, such as
+        '5m', or None if nothing has been recorded in it.'''
+        if key not in self.series:
+            return(None)
+        return(self.series[key].rollups[window].summary())
+
+
+RULEPATTERN = re.compile(r'^\s*(\S+?)\s*(>=|<=|>|<)\s*(-?[0-9.]+)'
+                         r'(?:\s+for\s+([0-9.]+)\s*([smh]?))?\s*$')
+RULEUNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600}
+RULESLACK = 0.05
+
+
+class AlertRule(object):
+    '''A threshold rule such as 'cpu > 90 for 30s' or 'disk:/dev/sda1 >
+    95', checked against every sample.  The metric may be a glob such as
+    'cpu:*', in which case each matching metric is checked on its own.
+    A rule fires when the metric has held past the threshold for the whole
+    duration: the window's minimum (for > and >=) or maximum (for < and <=)
+    is kept at the front of a monotonic deque, so each sample costs O(1)
+    amortized.  The duration allows RULESLACK seconds of scheduling jitter.
+    A missing or non-numeric value breaks the run.
+    >>> rule = AlertRule('cpu > 90 for 10s')
+    >>> [rule.observe({'cpu': 95.0}, t) for t in (0, 5, 10)][-1]
+    [('firing', 'cpu', 95.0)]
+    '''
+
+    def __init__(self, spec):
+        match = RULEPATTERN.match(spec)
+        if not match:
+            raise ValueError('rule should look like "cpu > 90 for 30s", ' +
+                             'not ' + repr(spec))
+        self.spec = spec.strip()
+        self.metric, self.op, threshold, duration, unit = match.groups()
+        self.threshold = float(threshold)
+        self.duration = float(duration or 0) * RULEUNITS[unit or '']
+        self.glob = bool(re.search(r'[*?\[]', self.metric))
+        self.windows = {}
+        self.started = {}
+        self.firing = set()
+
+    def holds(self, value):
+        if self.op == '>':
+            return(value > self.threshold)
+        if self.op == '>=':
+            return(value >= self.threshold)
+        if self.op == '<':
+            return(value < self.threshold)
+        return(value <= self.threshold)
+
+    def reset(self, key, events):
+        self.windows.pop(key, None)
+        self.started.pop(key, None)
+        if key in self.firing:
+            self.firing.discard(key)
+            events.append(('resolved', key, None))
+
+    def observe(self, sample, when):
+        '''Takes one collectsample() dictionary taken at when and returns a
+        list of (state, metric, value) events for metrics that started
+        firing or resolved.'''
+        events = []
+        if self.glob:
+            keys = [x for x in sample.keys() if fnmatchcase(x, self.metric)]
+        else:
+            keys = [self.metric]
+        seen = set()
+        for key in keys:
+            value = sample.get(key)
+            if not isnumber(value):
+                self.reset(key, events)
+                continue
+            seen.add(key)
+            window = self.windows.setdefault(key, deque())
+            self.started.setdefault(key, when)
+            if self.op in ('>', '>='):
+                while window and window[-1][1] >= value:
+                    window.pop()
+            else:
+                while window and window[-1][1] <= value:
+                    window.pop()
+            window.append((when, value))
+            while window[0][0] < when - self.duration - RULESLACK:
+                window.popleft()
+            extreme = window[0][1]
+            active = (when - self.started[key] >= self.duration - RULESLACK
+                      and self.holds(extreme))
+            if active and key not in self.firing:
+                self.firing.add(key)
+                events.append(('firing', key, extreme))
+            elif not active and key in self.firing:
+                self.firing.discard(key)
+                events.append(('resolved', key, value))
+        for key in set(self.windows) - seen:
+            self.reset(key, events)
+        return(events)
+
+
+def printevents(opts, rule, events, when):
+    '''Prints rule events as JSON objects in JSON formats, and otherwise
+    as ALERT or RESOLVED lines, on stdout in text and JSON formats and on
+    stderr in formats that cannot carry them.
+    '''
+    lines = []
+    for state, key, value in events:
+        if opts.format in ('jsonl', 'delta'):
+            lines.append(json.dumps(OrderedDict([
+                ('time', when), ('event', state), ('rule', rule.spec),
+                ('metric', key), ('value', value)])))
+        else:
+            lines.append('%s %s: %s = %s' % (
+                state == 'firing' and 'ALERT' or 'RESOLVED', rule.spec, key,
+                value))
+    if not lines:
+        return
+    if opts.format in ('text', 'jsonl', 'delta'):
+        sys.stdout.write('\n'.join(lines) + '\n')
+    else:
+        sys.stderr.write('\n'.join(lines) + '\n')
+
+
+HISTORYMAGIC = b'DDSTATS1'
+HISTORYHEADER = struct.Struct('<8sIIQ')
+HISTORYCHUNK = 4096
+
+
+def historycolumns(sample):
+    '''Returns the metric names of a collectsample() dictionary that a
+    history file can hold, which are the numeric ones.
+    >>> historycolumns({'cpu': 1.0, 'handles': 'Unknown'})
+    ['cpu']
+    '''
+    return([key for key, value in sample.items() if isnumber(value)])
+
+
+class HistoryFile(object):
+    '''Append-only binary history of samples, accessed through mmap.
+
+    The file starts with a header of the magic string, the header length,
+    the number of columns and the number of records, followed by the
+    NUL-separated column names padded to 8 bytes.  Each record is a
+    little-endian double timestamp followed by one double per column, with
+    NaN for metrics missing from a sample.  Records are fixed width and kept
+    in time order, so a time range is found by binary search.  Opening an
+    existing file keeps its columns; columns is only used to create one, and
+    append() warns once about each metric the file has no column for.
+    '''
+
+    def __init__(self, path, columns=None, writable=False):
+        self.path = path
+        self.writable = writable
+        if writable and not os.path.exists(path):
+            self.create(columns)
+        self.handle = open(path, writable and 'r+b' or 'rb')
+        header = self.handle.read(HISTORYHEADER.size)
+        if len(header) < HISTORYHEADER.size:
+            raise ValueError(path + ' is not a ddstats history file')
+        magic, self.headersize, ncolumns, records = HISTORYHEADER.unpack(
+            header)
+        if magic != HISTORYMAGIC:
+            raise ValueError(path + ' is not a ddstats history file')
+        names = self.handle.read(self.headersize - HISTORYHEADER.size)
+        self.columns = [x.decode('utf-8') for x in
+                        names.rstrip(b'\0').split(b'\0')][:ncolumns]
+        self.record = struct.Struct('<%dd' % (1 + ncolumns))
+        self.known = set(self.columns)
+        self.mapping = None
+        self.remap()
+        self.records = min(records, self.capacity)
+
+    def create(self, columns):
+        names = b'\0'.join(x.encode('utf-8') for x in columns) + b'\0'
+        headersize = HISTORYHEADER.size + len(names)
+        headersize += -headersize % 8
+        with open(self.path, 'wb') as handle:
+            handle.write(HISTORYHEADER.pack(HISTORYMAGIC, headersize,
+                                            len(columns), 0))
+            handle.write(names.ljust(headersize - HISTORYHEADER.size,
+                                     b'\0'))
+
+    def remap(self, minimum=0):
+        '''Maps the whole file, first growing it to hold at least minimum
+        records when writing.'''
+        if self.mapping is not None:
+            self.mapping.close()
+        self.handle.seek(0, os.SEEK_END)
+        size = self.handle.tell()
+        if self.writable and minimum:
+            size = (self.headersize + self.record.size *
+                    (minimum + HISTORYCHUNK))
+            self.handle.truncate(size)
+        self.capacity = (size - self.headersize) // self.record.size
+        if self.writable:
+            self.mapping = mmap.mmap(self.handle.fileno(), size)
+        else:
+            self.mapping = mmap.mmap(self.handle.fileno(), size,
+                                     access=mmap.ACCESS_READ)
+
+    def append(self, when, sample):
+        '''Appends one collectsample() dictionary taken at when.  A clock
+        that stepped backwards is recorded at the previous time so the file
+        stays sorted.'''
+        dropped = set(historycolumns(sample)) - self.known
+        if dropped:
+            OUTERR('%s has no column for %s, not recorded' % (
+                self.path, ', '.join(sorted(dropped))))
+            self.known |= dropped
+        if self.records:
+            when = max(when, self.time(self.records - 1))
+        if self.records >= self.capacity:
+            self.remap(self.records + 1)
+        values = [when]
+        for key in self.columns:
+            value = sample.get(key)
+            if isnumber(value):
+                values.append(value)
+            else:
+                values.append(float('nan'))
+        self.record.pack_into(self.mapping, self.offset(self.records),
+                              *values)
+        self.records += 1
+        struct.pack_into('<Q', self.mapping, HISTORYHEADER.size - 8,
+                         self.records)
+
+    def offset(self, index):
+        return(self.headersize + index * self.record.size)
+
+    def time(self, index):
+        return(struct.unpack_from('<d', self.mapping, self.offset(index))[0])
+
+    def __len__(self):
+        return(self.records)
+
+    def __getitem__(self, index):
+        return(self.time(index))
+
+    def find(self, when):
+        '''Returns the index of the first record at or after when.'''
+        return(bisect_left(self, when))
+
+    def slice(self, since=None, until=None):
+        '''Generator of record tuples, timestamp first, from since up to
+        and including until.'''
+        start = 0
+        end = self.records
+        if since is not None:
+            start = self.find(since)
+        if until is not None:
+            end = bisect_right(self, until, start)
+        for index in range(start, end):
+            yield(self.record.unpack_from(self.mapping, self.offset(index)))
+
+    def close(self):
+        '''Unmaps the file and trims the unused preallocated tail.'''
+        self.mapping.close()
+        if self.writable:
+            self.handle.truncate(self.offset(self.records))
+        self.handle.close()
+
+
+def dumphistory(path, since=None, until=None, out=sys.stdout):
+    '''Writes the records of history file path between since and until as
+    CSV with a header row, in blocks rather than line by line.  Missing
+    values are left empty.
+    '''
+    history = HistoryFile(path)
+    try:
+        out.write(','.join(['time'] + history.columns) + '\n')
+        lines = []
+        for record in history.slice(since, until):
+            lines.append(','.join('' if x != x else repr(x)
+                                  for x in record))
+            if len(lines) >= HISTORYCHUNK:
+                out.write('\n'.join(lines) + '\n')
+                lines = []
+        if lines:
+            out.write('\n'.join(lines) + '\n')
+    finally:
+        history.close()
+
+
+OUTPUTFORMATS = ['text', 'jsonl', 'csv', 'prom', 'delta']
+PROMLABELS = {'cpu': 'cpu', 'disk': 'device', 'diskio': 'device'}
+PROMLABELS.update((x, 'device') for x in DISKSTATS)
+PROMLABELS['top'] = 'process'
+PROMLABELS.update((x, 'cgroup') for x in CGROUPSTATS)
+PROMLABELS.update((x, 'resource') for x in PRESSURESTATS)
+PROMLABELS.update((x, 'collector') for x in SELFSTATS)
+
+
+def promescape(value):
+    '''Escapes a Prometheus label value.
+    >>> promescape('a"b')
+    'a\\\\"b'
+    '''
+    return(value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'))
+
+
+def promformat(sample, when=None):
+    '''Returns a collectsample() dictionary as Prometheus text exposition.
+    A metric such as disk:/dev/sda1 becomes ddstats_disk{device="/dev/sda1"}
+    and values that are not numbers are left out.  With when, every line
+    carries that UNIX time as a timestamp.
+    >>> promformat({'cpu:0': 5.0})
+    '# TYPE ddstats_cpu gauge\\nddstats_cpu{cpu="0"} 5.0\\n'
+    '''
+    families = OrderedDict()
+    stamp = ''
+    if when is not None:
+        stamp = ' %d' % (when * 1000)
+    for key, value in sample.items():
+        if not isnumber(value):
+            continue
+        family, _, label = key.partition(':')
+        name = 'ddstats_' + re.sub('[^a-zA-Z0-9_]', '_', family)
+        if label:
+            name += '{%s="%s"}' % (PROMLABELS.get(family, 'name'),
+                                   promescape(label))
+        families.setdefault(family, []).append(
+            '%s %s%s' % (name, repr(float(value)), stamp))
+    lines = []
+    for family, values in families.items():
+        lines.append('# TYPE ddstats_%s gauge' %
+                     re.sub('[^a-zA-Z0-9_]', '_', family))
+        lines.extend(values)
+    return('\n'.join(lines) + '\n')
+
+
+class DeltaEncoder(object):
+    '''Turns a stream of samples into compact JSON Lines records that only
+    carry what changed.  Every keyframe samples a full record is written:
+    {"t": time, "k": {metric: value, ...}}.  In between, a metric is only
+    written once it has moved from the value last written for it by more
+    than the larger of deadband and reldeadband percent of that value, and
+    then as its difference from the keyframe: {"t": time, "d": {metric:
+    delta}}.  Metrics that are new since the keyframe or not numbers go
+    under "n" as plain values, and metrics that disappeared are listed under
+    "x".  Samples with nothing to report produce no record at all.
+    >>> encoder = DeltaEncoder(keyframe=10)
+    >>> encoder.format({'cpu': 5.0, 'procs': 80}, 0)
+    '{"t": 0, "k": {"cpu": 5.0, "procs": 80}}\\n'
+    >>> encoder.format({'cpu': 7.5, 'procs': 80}, 1)
+    '{"t": 1, "d": {"cpu": 2.5}}\\n'
+    '''
+
+    def __init__(self, deadband=0.0, reldeadband=0.0, keyframe=60):
+        self.deadband = deadband
+        self.reldeadband = reldeadband / 100.0
+        self.keyframe = keyframe
+        self.base = None
+        self.last = {}
+        self.sincekeyframe = 0
+
+    def moved(self, key, value):
+        '''Returns True if value is outside the deadband of the value last
+        written for key.'''
+        if key not in self.last:
+            return(True)
+        last = self.last[key]
+        if not (isnumber(value) and isnumber(last)):
+            return(value != last)
+        change = abs(value - last)
+        return(change > 0 and change > max(self.deadband,
+                                           self.reldeadband * abs(last)))
+
+    def format(self, sample, when):
+        if self.base is None or self.sincekeyframe >= self.keyframe:
+            self.base = OrderedDict(sample)
+            self.last = dict(sample)
+            self.sincekeyframe = 1
+            return(json.dumps(OrderedDict([('t', when),
+                                           ('k', self.base)])) + '\n')
+        self.sincekeyframe += 1
+        deltas = OrderedDict()
+        plain = OrderedDict()
+        for key, value in sample.items():
+            if not self.moved(key, value):
+                continue
+            self.last[key] = value
+            base = self.base.get(key)
+            if isnumber(value) and isnumber(base):
+                deltas[key] = round(value - base, 6)
+            else:
+                plain[key] = value
+        gone = [x for x in self.last if x not in sample]
+        for key in gone:
+            del self.last[key]
+        record = OrderedDict([('t', when)])
+        if deltas:
+            record['d'] = deltas
+        if plain:
+            record['n'] = plain
+        if gone:
+            record['x'] = sorted(gone)
+        if len(record) == 1:
+            return('')
+        return(json.dumps(record) + '\n')
+
+
+class SampleWriter(object):
+    '''Writes collectsample() dictionaries to out as JSON Lines, CSV,
+    Prometheus text or DeltaEncoder records, building each record whole and
+    writing it in one call.  CSV takes its columns, and its header row, from
+    the first sample.  The deadband and keyframe settings only apply to the
+    delta format.
+    '''
+
+    def __init__(self, fmt, out=sys.stdout, deadband=0.0, reldeadband=0.0,
+                 keyframe=60):
+        self.fmt = fmt
+        self.out = out
+        self.columns = None
+        self.encoder = DeltaEncoder(deadband, reldeadband, keyframe)
+
+    def format(self, sample, when):
+        if self.fmt == 'jsonl':
+            record = OrderedDict([('time', when)])
+            record.update(sample)
+            return(json.dumps(record) + '\n')
+        if self.fmt == 'csv':
+            text = ''
+            if self.columns is None:
+                self.columns = list(sample.keys())
+                text = ','.join(['time'] + self.columns) + '\n'
+            values = [sample.get(x, '') for x in self.columns]
+            return(text + ','.join(csvfield(x) for x in [when] + values) +
+                   '\n')
+        if self.fmt == 'prom':
+            return(promformat(sample, when))
+        if self.fmt == 'delta':
+            return(self.encoder.format(sample, when))
+        raise ValueError('unknown output format ' + repr(self.fmt))
+
+    def write(self, sample, when):
+        record = self.format(sample, when)
+        if record:
+            self.out.write(record)
+
+
+def csvfield(value):
+    '''Returns value as a CSV field, quoted if it needs to be.
+    >>> csvfield('a,b')
+    '"a,b"'
+    '''
+    if isnumber(value):
+        return(repr(value))
+    value = str(value)
+    if re.search('[",\n]', value):
+        value = '"' + value.replace('"', '""') + '"'
+    return(value)
+
+
+def wanted(opts, key):
+    '''Returns True if metric key, or every metric under a prefix such as
+    'cpu:', belongs in a sample collected for opts.  A full opts, as used by
+    the daemon, wants everything, and so does a --rule on the metric.
+    '''
+    if getattr(opts, 'full', False):
+        return(True)
+    if any(rulecovers(x, key) for x in getattr(opts, 'rulemetrics', ())):
+        return(True)
+    metric, labelled, label = key.partition(':')
+    if metric == 'cpu':
+        return((opts.cpu or opts.all) and (opts.verbose or not labelled))
+    if metric == 'ram':
+        return(opts.memory or opts.all)
+    if metric in ('ramused', 'ramtotal'):
+        return((opts.memory or opts.all) and opts.verbose)
+    if metric == 'disk':
+        return(opts.disk or opts.all)
+    if metric == 'diskio':
+        if labelled:
+            return(((opts.diskio and opts.verbose) or opts.all) and
+                   diskselected(opts, label))
+        return(opts.diskio and not opts.verbose and not opts.all)
+    if metric in DISKSTATS:
+        return(opts.diskstats and diskselected(opts, label))
+    if metric == 'procs':
+        return(opts.procs or opts.all)
+    if metric == 'uniqueprocs':
+        return((opts.procs or opts.all) and opts.verbose)
+    if metric in ('handles', 'handlescounted', 'handlesskipped'):
+        return(opts.handles or opts.all)
+    if metric == 'top':
+        return(bool(opts.top))
+    if metric in CGROUPSTATS:
+        return(opts.cgroups)
+    if metric in PRESSURESTATS:
+        return(bool(opts.pressure))
+    if metric in SELFSTATS:
+        return(opts.selfstats)
+    return(False)
+
+
+def rulecovers(metric, key):
+    '''Returns True if a rule on metric, which may be a glob, can see the
+    metric key, or some metric under key when key is a prefix such as
+    'disk:'.
+    >>> rulecovers('disk:/dev/*', 'disk:'), rulecovers('cpu', 'cpu:')
+    (True, False)
+    '''
+    if not key.endswith(':'):
+        return(fnmatchcase(key, metric))
+    head = re.split(r'[*?\[]', metric)[0]
+    if head != metric:
+        return(head.startswith(key) or key.startswith(head))
+    return(metric.startswith(key))
+
+
+def rulecollected(opts, metric):
+    '''Returns True if a sample collected for opts can hold metric, the
+    metric or glob of a rule.
+    '''
+    keys = [key for entry in collectors(opts)
+            if entry.name != 'top' or opts.top for key in entry.keys]
+    if opts.selfstats:
+        keys.extend(x + ':' for x in SELFSTATS)
+    return(any(rulecovers(metric, x) for x in keys))
+
+
+def selectsample(opts, sample):
+    '''Returns the metrics of a full sample that a sample collected for opts
+    would hold, in the same order.
+    '''
+    return(OrderedDict((key, value) for key, value in sample.items()
+                       if wanted(opts, key)))
+
+
+Collector = namedtuple('Collector', ['name', 'function', 'keys', 'needs',
+                                     'cost', 'platforms'])
+
+COLLECTORS = OrderedDict()
+COLLECTORCOSTS = ('cheap', 'expensive', 'blocking')
+COLLECTORWORKERS = 4
+collectorpool = None
+
+
+def collector(name, keys, needs=(), cost='cheap', platforms=None):
+    '''Registers the decorated function as collector name.  It runs when
+    opts want any metric or prefix in keys, after every collector in needs
+    that also runs, and returns an ordered dictionary of metrics.  A needs
+    of 'rates' means it works from a samplerates() dictionary.  Cheap
+    collectors run inline, expensive and blocking ones concurrently, and
+    platforms, if given, are the sys.platform prefixes it runs on.
+    '''
+    if cost not in COLLECTORCOSTS:
+        raise ValueError('unknown collector cost ' + repr(cost))
+
+    def register(function):
+        COLLECTORS[name] = Collector(name, function, tuple(keys),
+                                     tuple(needs), cost, platforms)
+        return(function)
+    return(register)
+
+
+def collectors(opts):
+    '''Returns the registered Collectors that opts want, in registry
+    order, leaving out those for other platforms.
+    '''
+    selected = []
+    for entry in COLLECTORS.values():
+        if entry.platforms is not None and not any(
+                sys.platform.startswith(x) for x in entry.platforms):
+            continue
+        if any(wanted(opts, x) for x in entry.keys):
+            selected.append(entry)
+    return(selected)
+
+
+def needsrates(opts):
+    '''Returns True if any collector opts want works from rates.'''
+    return(any('rates' in x.needs for x in collectors(opts)))
+
+
+@collector('cpu', ['cpu', 'cpu:'], needs=['rates'])
+def collectcpu(opts, rates, shared):
+    sample = OrderedDict()
+    if wanted(opts, 'cpu'):
+        sample['cpu'] = rates['totalcpu']
+    if wanted(opts, 'cpu:'):
+        for cpu, percent in enumerate(rates['eachcpu']):
+            sample['cpu:' + str(cpu)] = percent
+    return(sample)
+
+
+@collector('memory', ['ram'])
+def collectmemory(opts, rates, shared):
+    sample = OrderedDict()
+    ram = virtualmemory()
+    sample['ram'] = ram.percent
+    if wanted(opts, 'ramused'):
+        sample['ramused'] = ram.total - ram.available
+        sample['ramtotal'] = ram.total
+    return(sample)
+
+
+@collector('disk', ['disk:'], cost='blocking')
+def collectdisk(opts, rates, shared):
+    sample = OrderedDict()
+    diskstatus = eachdiskspace(opts.disktimeout)
+    for disk in diskstatus.keys():
+        sample['disk:' + disk] = diskstatus[disk]
+    return(sample)
+
+
+@collector('diskio', ['diskio', 'diskio:'], needs=['rates'])
+def collectdiskio(opts, rates, shared):
+    sample = OrderedDict()
+    if wanted(opts, 'diskio'):
+        sample['diskio'] = rates['totaldiskio']
+    if wanted(opts, 'diskio:'):
+        diskstatus = rates['eachdiskio'] or {}
+        for disk in diskstatus.keys():
+            if wanted(opts, 'diskio:' + disk):
+                sample['diskio:' + disk] = diskstatus[disk]
+    return(sample)
+
+
+@collector('diskstats', [x + ':' for x in DISKSTATS], needs=['rates'])
+def collectdiskstats(opts, rates, shared):
+    sample = OrderedDict()
+    snap1, snap2 = rates['snapshots']
+    for disk in (snap2.eachdiskio or {}).keys():
+        if disk not in (snap1.eachdiskio or {}):
+            continue
+        for key, value in diskrates(snap1.eachdiskio[disk],
+                                    snap2.eachdiskio[disk],
+                                    snap2.time - snap1.time).items():
+            if wanted(opts, key + ':' + disk):
+                sample[key + ':' + disk] = value
+    return(sample)
+
+
+@collector('uniqueprocs', ['uniqueprocs'], cost='expensive')
+def collectuniqueprocs(opts, rates, shared):
+    shared['processlist'] = proctable(['pid', 'name'])
+    countscanned(len(shared['processlist']))
+    return(OrderedDict([('uniqueprocs',
+                         uniqueprocesscount(shared['processlist']))]))
+
+
+@collector('procs', ['procs'], needs=['uniqueprocs'])
+def collectprocs(opts, rates, shared):
+    return(OrderedDict([('procs',
+                         processcount(shared.get('processlist', [])))]))
+
+
+@collector('handles', ['handles'], cost='expensive')
+def collecthandles(opts, rates, shared):
+    census = fhcensus()
+    countscanned(census.counted + census.skipped)
+    return(OrderedDict([('handles', census.handles),
+                        ('handlescounted', census.counted),
+                        ('handlesskipped', census.skipped)]))
+
+
+@collector('cgroups', [x + ':' for x in CGROUPSTATS], needs=['rates'],
+           platforms=['linux'])
+def collectcgroups(opts, rates, shared):
+    sample = OrderedDict()
+    if 'snapshots' not in rates:
+        return(sample)
+    snap1, snap2 = rates['snapshots']
+    for cgroup in sorted((snap2.cgroups or {}).keys()):
+        if cgroup not in (snap1.cgroups or {}):
+            continue
+        for key, value in cgrouprates(snap1.cgroups[cgroup],
+                                      snap2.cgroups[cgroup],
+                                      snap2.time - snap1.time).items():
+            sample[key + ':' + cgroup] = value
+    return(sample)
+
+
+@collector('pressure', [x + ':' for x in PRESSURESTATS],
+           platforms=['linux'])
+def collectpressure(opts, rates, shared):
+    sample = OrderedDict()
+    stats = pressurestats(opts.pressurefs)
+    for resource in sorted(set(stats) | set(rates.get('pressure', []))):
+        some, full = stats.get(resource, (None, None))
+        sample['pressure:' + resource] = some
+        sample['pressurefull:' + resource] = full
+        sample['pressureevent:' + resource] = int(
+            resource in rates.get('pressure', []))
+    return(sample)
+
+
+@collector('top', ['top:'], needs=['rates'], cost='expensive')
+def collecttop(opts, rates, shared):
+    sample = OrderedDict()
+    if not opts.top:
+        return(sample)
+    tracker = trackprocesses()
+    for value, pid, name in tracker.rank(opts.top, opts.sort):
+        sample['top:%d/%s' % (pid, name)] = value
+    countscanned(len(tracker.processes))
+    return(sample)
+
+
+def collectsample(opts, rates):
+    '''Collects the metrics selected in opts into an ordered dictionary of
+    flat metric names, such as cpu, cpu:0, ram, disk:/dev/sda1, diskio:sda,
+    procs and handles.  The rate metrics come from a samplerates() dictionary.
+    Each collector starts once those it needs are done.  When more than one
+    is expensive or blocking, those run together on a pool of threads while
+    the cheap ones run here, and the sample keeps registry order either way.
+    With opts.selfstats every collector runs here, one at a time, so that
+    what the whole process spends can be charged to it.  Its SELFSTATS
+    follow the metrics under its name, and the whole sample's come under
+    total, with the load of the process since the previous sample.
+    '''
+    global collectorpool, selflast
+    selected = collectors(opts)
+    running = set(x.name for x in selected)
+    measure = opts.selfstats
+    if measure:
+        start = selfcounters()
+    costs = OrderedDict()
+    pool = None
+    if len([x for x in selected if x.cost != 'cheap']) > 1 and not measure:
+        if collectorpool is None:
+            collectorpool = DeadlinePool(COLLECTORWORKERS)
+        pool = collectorpool
+    shared = {}
+    results = {}
+    jobs = OrderedDict()
+    waiting = list(selected)
+    while waiting or jobs:
+        ready = [x for x in waiting
+                 if not (set(x.needs) & running) - set(results)]
+        if ready:
+            # hand the slow ones to the pool before working on the rest
+            entry = sorted(ready, key=lambda x: x.cost == 'cheap')[0]
+            waiting.remove(entry)
+            if pool is not None and entry.cost != 'cheap':
+                jobs[entry.name] = pool.submit(entry.function, opts, rates,
+                                               shared)
+            else:
+                if measure:
+                    before = selfcounters()
+                results[entry.name] = entry.function(opts, rates, shared)
+                if measure:
+                    costs[entry.name] = selfcost(before, selfcounters())
+            continue
+        if not jobs:
+            raise RuntimeError('collectors ' + ', '.join(
+                x.name for x in waiting) + ' need each other')
+        name, job = jobs.popitem(last=False)
+        job.wait(None)
+        if job.error is not None:
+            raise job.error
+        results[name] = job.result
+    sample = OrderedDict()
+    for entry in selected:
+        sample.update(results[entry.name])
+    if measure:
+        costs['total'] = selfcost(start, selfcounters(), 2 * len(costs))
+        now = selfcounters()
+        if 'time' in rates and now.wall > selflast.wall:
+            # a one-shot run never sleeps, so its load would read as 100%
+            costs['total']['selfload'] = ((now.cpu - selflast.cpu) * 100.0 /
+                                          (now.wall - selflast.wall))
+        selflast = now
+        for name in [x.name for x in selected] + ['total']:
+            for key, value in costs[name].items():
+                sample[key + ':' + name] = value
+    return(sample)
+
+
+def printtable(sample, columns, sizes=[]):
+    '''Prints one line per label of the metrics in columns, such as the
+    devices of DISKSTATS, naming each figure by its column heading.  Metrics
+    in sizes are printed human-readable and None values are left out.
+    '''
+    rows = OrderedDict()
+    for key, value in sample.items():
+        metric, _, label = key.partition(':')
+        if metric not in columns or value is None:
+            continue
+        if metric in sizes:
+            value = sizeof_fmt(value)
+        else:
+            value = round(value, 2)
+        rows.setdefault(label, []).append(columns[metric] + ' ' + str(value))
+    for label, values in rows.items():
+        OUTPUT(label + ' :  ' + ' '.join(values))
+
+
+def printsample(opts, sample):
+    '''Prints a collectsample() dictionary the way ddstats always has:
+    bare values on stdout and INI-style labels on stderr.
+    '''
+    if opts.cpu or opts.all:
+        if opts.label:
+            OUTERR('\n[CPU]')
+        OUTPUT(sample['cpu'])
+        for key in sample.keys():
+            if key.startswith('cpu:'):
+                OUTPUT('cpu' + key[4:] + ' :  ' + str(sample[key]))
+    if opts.memory or opts.all:
+        if opts.label:
+            OUTERR('\n[MEMORY]')
+        if 'ramtotal' in sample:
+            OUTPUT(sizeof_fmt(sample['ramused']) + ' / ' +
+                   sizeof_fmt(sample['ramtotal']))
+        else:
+            OUTPUT(str(sample['ram']))
+    if opts.disk or opts.all:
+        if opts.label:
+            OUTERR('\n[DISK]')
+        for key in sample.keys():
+            if key.startswith('disk:'):
+                OUTPUT(key[5:] + ' :  ' + str(sample[key]))
+    if opts.diskio or opts.all:
+        if opts.label:
+            OUTERR('\n[DISKIO]')
+        if 'diskio' in sample:
+            OUTPUT(sample['diskio'])
+        for key in sample.keys():
+            if key.startswith('diskio:'):
+                OUTPUT(key[7:] + ' :  ' + str(sample[key]))
+    if opts.diskstats:
+        if opts.label:
+            OUTERR('\n[DISKSTATS]')
+        printtable(sample, DISKSTATS)
+    if opts.cgroups:
+        if opts.label:
+            OUTERR('\n[CGROUPS]')
+        printtable(sample, CGROUPSTATS, ['cgroupmemory', 'cgroupmemorymax'])
+    if opts.pressure:
+        if opts.label:
+            OUTERR('\n[PRESSURE]')
+        printtable(sample, PRESSURESTATS)
+    if opts.procs or opts.all:
+        if opts.label:
+            OUTERR('\n[PROCESSES]')
+        if 'uniqueprocs' in sample:
+            OUTPUT(str(sample['uniqueprocs']) +
+                   ' unique from a total of ' + str(sample['procs']))
+        else:
+            OUTPUT(sample['procs'])
+    if opts.handles or opts.all:
+        if opts.label:
+            OUTERR('\n[HANDLES]')
+        if opts.verbose:
+            OUTPUT(str(sample['handles']) + ' from ' +
+                   str(sample['handlescounted']) + ' processes, ' +
+                   str(sample['handlesskipped']) + ' skipped')
+        else:
+            OUTPUT(sample['handles'])
+    if opts.top:
+        if opts.label:
+            OUTERR('\n[TOP ' + opts.sort + ']')
+        for key, value in sample.items():
+            if key.startswith('top:'):
+                OUTPUT(key[4:] + ' :  ' + str(value))
+    if opts.selfstats:
+        if opts.label:
+            OUTERR('\n[SELFSTATS]')
+        printtable(sample, SELFSTATS)
+
+
+def printrollups(opts, store):
+    '''Prints the rollup of every metric in store over opts.rollup as one
+    line per metric.
+    '''
+    if opts.label:
+        OUTERR('\n[ROLLUP ' + opts.rollup + ']')
+    for key in store.series.keys():
+        summary = store.summary(key, opts.rollup)
+        if summary:
+            OUTPUT(key + ' :  ' + ' '.join('%s %s' % (k, round(v, 2))
+                                           for k, v in summary.items()))
+
+
+class SampleCache(object):
+    '''Latest sample of a background collector, shared between threads.
+    Each rendering of a sample is built once and handed to every reader
+    until the next sample replaces it.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sample = None
+        self.when = None
+        self.rendered = {}
+
+    def update(self, sample, when):
+        with self.lock:
+            self.sample = sample
+            self.when = when
+            self.rendered = {}
+
+    def render(self, fmt='prom'):
+        '''Returns the latest sample as bytes in fmt, or None if nothing
+        has been collected yet.'''
+        with self.lock:
+            if self.sample is None:
+                return(None)
+            if fmt not in self.rendered:
+                if fmt == 'prom':
+                    sample = OrderedDict(self.sample)
+                    sample['sampletime'] = self.when
+                    text = promformat(sample)
+                else:
+                    text = SampleWriter(fmt).format(self.sample, self.when)
+                self.rendered[fmt] = text.encode('utf-8')
+            return(self.rendered[fmt])
+
+
+def cgroupsource(opts):
+    '''Returns the tuple of cgroup v2 mount and depth that snapshot()
+    should walk for opts, or None if cgroups were not asked for.
+    '''
+    if not opts.cgroups:
+        return(None)
+    root = opts.cgroupfs or cgroupmount()
+    if root is None:
+        raise RuntimeError('no cgroup v2 hierarchy is mounted')
+    return((root, opts.cgroupdepth))
+
+
+def collectforever(opts, cache):
+    '''Collects the metrics selected in opts every sample interval into
+    cache, for ever.  A failed tick is reported on stderr and the previous
+    sample stays in place.
+    '''
+    for rates in itersamples(opts.sample_interval, None,
+                             cgroupsource(opts)):
+        try:
+            cache.update(collectsample(opts, rates), rates['time'])
+        except Exception as e:
+            OUTERR('collection failed: ' + repr(e))
+
+
+def startcollector(opts, cache):
+    '''Runs collectforever() on a daemon thread and returns the thread.'''
+    collector = threading.Thread(target=collectforever, args=(opts, cache))
+    collector.daemon = True
+    collector.start()
+    return(collector)
+
+
+def servemetrics(opts, cache):
+    '''Serves the cached sample as Prometheus text on /metrics at
+    opts.bind:opts.serve until interrupted.  Scrapes never collect; they get
+    the bytes rendered for the latest sample, or 503 before the first one.
+    '''
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = cache.render('prom')
+            if body is None:
+                self.send_response(503)
+                self.send_header('Retry-After', str(opts.sample_interval))
+                body = b'no sample collected yet\n'
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            if opts.verbose:
+                BaseHTTPRequestHandler.log_message(self, *args)
+
+    class MetricsServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = MetricsServer((opts.bind, opts.serve), MetricsHandler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+DAEMONSOCKET = os.environ.get('DDSTATS_SOCKET', '/tmp/ddstats.sock')
+
+
+def querydaemon(path=DAEMONSOCKET, timeout=1.0):
+    '''Asks a ddstats daemon listening on path for its latest sample.
+    Returns a tuple of the sample time and the full sample, or None if no
+    daemon answers, it has no sample yet, or the socket belongs to neither
+    us nor root.
+    '''
+    try:
+        if os.stat(path).st_uid not in (0, os.getuid()):
+            return(None)
+    except OSError:
+        return(None)
+    if not hasattr(socket, 'AF_UNIX'):
+        return(None)
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.settimeout(timeout)
+            client.connect(path)
+            client.sendall(b'sample\n')
+            reply = b''
+            while not reply.endswith(b'\n'):
+                data = client.recv(65536)
+                if not data:
+                    break
+                reply += data
+        finally:
+            client.close()
+        sample = json.loads(reply.decode('utf-8'),
+                            object_pairs_hook=OrderedDict)
+    except (OSError, IOError, ValueError):
+        return(None)
+    if 'time' not in sample:
+        return(None)
+    return((sample.pop('time'), sample))
+
+
+def servedaemon(opts, cache):
+    '''Answers queries for the cached sample on the Unix socket
+    opts.socket with asyncio until interrupted.  Each request is a line;
+    "sample" gets the latest sample as one JSON line, {} before the first
+    one.  Clients may keep the connection open for further requests.
+    '''
+    import asyncio
+
+    class DaemonProtocol(asyncio.Protocol):
+        def connection_made(self, transport):
+            self.transport = transport
+            self.buffer = b''
+
+        def data_received(self, data):
+            self.buffer += data
+            while b'\n' in self.buffer:
+                request, self.buffer = self.buffer.split(b'\n', 1)
+                request = request.strip()
+                if request == b'sample':
+                    self.transport.write(cache.render('jsonl') or b'{}\n')
+                else:
+                    self.transport.write(b'{"error": "unknown request"}\n')
+
+    if os.path.exists(opts.socket):
+        if querydaemon(opts.socket) is not None:
+            raise RuntimeError('a daemon is already answering on ' +
+                               opts.socket)
+        os.unlink(opts.socket)
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        loop.create_unix_server(DaemonProtocol, opts.socket))
+    os.chmod(opts.socket, 0o666)
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        os.unlink(opts.socket)
+
+
 def main(argv=None):
     '''Command line options parsing.  Takes arrays and returns an integers.
     >>> main([])
@@ -243,6 +2550,7 @@ def main(argv=None):
 
     if argv is None:
         argv = sys.argv[1:]
+    status = 0
     try:
         # setup option parser
         parser = OptionParser(version=program_version_string,
@@ -257,8 +2565,10 @@ def main(argv=None):
                           [default: %default]")
         parser.add_option("-t", "--interval", dest="sample_interval",
                           action="store", type="int",
-                          help="Set the interval for polling disk IO. \
-                          [default: %default]")
+                          help="Set the sampling window shared by CPU \
+                          and disk IO, and the interval between samples. \
+                          [default: 1 for a single sample without disk IO, \
+                          otherwise 5]")
         parser.add_option("-u", "--cpu", dest="cpu", action="store_true",
                           help="Get total CPU utilization \
                           or per-CPU if verbose")
@@ -267,9 +2577,29 @@ def main(argv=None):
                           or ratio if verbose")
         parser.add_option("-d", "--disk", dest="disk", action="store_true",
                           help="Get per-device disk utilization")
+        parser.add_option("--disktimeout", dest="disktimeout",
+                          action="store", type="float", metavar="SECONDS",
+                          help="Report a mount as timed out if it does not \
+                          answer within this time. [default: %default]")
         parser.add_option("-i", "--diskio", dest="diskio", action="store_true",
                           help="Get total transactions per second \
                           for a specified interval or per-disk if verbose")
+        parser.add_option("-I", "--diskstats", dest="diskstats",
+                          action="store_true",
+                          help="Get read and write IOPS and bytes per \
+                          second, percent utilization and average wait \
+                          for each disk over the interval.")
+        parser.add_option("--disks", dest="disks", action="store",
+                          metavar="REGEX",
+                          help="Only report disk IO for devices matching \
+                          this regular expression.")
+        parser.add_option("--nopartitions", dest="nopartitions",
+                          action="store_true",
+                          help="Leave partitions out of per-disk IO.")
+        parser.add_option("--novirtual", dest="novirtual",
+                          action="store_true",
+                          help="Leave dm, loop and ram devices out of \
+                          per-disk IO.")
         parser.add_option("-p", "--procs", dest="procs", action="store_true",
                           help="Get process count \
                           or compare unique process count \
@@ -278,87 +2608,304 @@ def main(argv=None):
                           action="store_true",
                           help="Get number of open file handles.  \
                           Usually requires privilege escalation.")
+        parser.add_option("-g", "--cgroups", dest="cgroups",
+                          action="store_true",
+                          help="Get CPU use and throttling, memory against \
+                          its limit, and IO rates for each cgroup v2 \
+                          group over the interval.")
+        parser.add_option("--cgroupdepth", dest="cgroupdepth",
+                          action="store", type="int", metavar="N",
+                          help="Report cgroups down to this many levels \
+                          below the root. [default: %default]")
+        parser.add_option("--cgroupfs", dest="cgroupfs", action="store",
+                          metavar="PATH",
+                          help="Read cgroups from here instead of the \
+                          mounted cgroup v2 hierarchy.")
+        parser.add_option("--pressure", dest="pressure", action="append",
+                          metavar="TRIGGER",
+                          help="Sleep until this PSI trigger fires, such as \
+                          'memory some 150000 2000000' (stall and window in \
+                          microseconds), then collect one sample.  May be \
+                          repeated; --count and --follow count events.")
+        parser.add_option("--pressurefs", dest="pressurefs", action="store",
+                          metavar="PATH",
+                          help="Directory holding the cpu, memory and io \
+                          pressure files. [default: %default]")
+        parser.add_option("--top", dest="top", action="store", type="int",
+                          metavar="N",
+                          help="List the N hottest processes over the \
+                          interval, by --sort.")
+        parser.add_option("--sort", dest="sort", action="store",
+                          type="choice", choices=TOPSORTS,
+                          help="Rank --top processes by cpu, rss, io \
+                          (bytes per second) or fds. [default: %default]")
         parser.add_option("-a", "--all", dest="all", action="store_true",
                           help="Perform all of the above checks.  \
                           Usually requires privilege escalation.")
+        parser.add_option("-r", "--rollup", dest="rollup", action="store",
+                          type="choice", choices=list(ROLLUPWINDOWS.keys()),
+                          help="After each sample, print min, mean, max and \
+                          percentiles of every metric over this window: \
+                          1m, 5m or 15m.  Text format only.")
+        parser.add_option("-o", "--format", dest="format", action="store",
+                          type="choice", choices=OUTPUTFORMATS,
+                          help="Write each sample as text, jsonl, csv, \
+                          prom (Prometheus text) or delta (JSON Lines of \
+                          changes against periodic keyframes). \
+                          [default: %default]")
+        parser.add_option("--deadband", dest="deadband", action="store",
+                          type="float",
+                          help="With delta format, skip metrics that moved \
+                          by no more than this much. [default: %default]")
+        parser.add_option("--reldeadband", dest="reldeadband",
+                          action="store", type="float", metavar="PERCENT",
+                          help="With delta format, skip metrics that moved \
+                          by no more than this percent. [default: %default]")
+        parser.add_option("--keyframe", dest="keyframe", action="store",
+                          type="int", metavar="N",
+                          help="With delta format, write every metric in \
+                          full every N samples. [default: %default]")
+        parser.add_option("--rule", dest="rules", action="append",
+                          metavar="RULE",
+                          help="Report when a metric crosses a threshold, \
+                          optionally for a sustained time, such as \
+                          'cpu > 90 for 30s' or 'disk:/dev/sda1 > 95'.  \
+                          May be repeated.  Exit status is 1 if any rule \
+                          fired.  Not with --serve or --daemon.")
+        parser.add_option("-H", "--history", dest="history",
+                          action="store", metavar="FILE",
+                          help="Append every sample to this binary history \
+                          file.  Its columns are fixed when it is created; \
+                          later metrics are not recorded.")
+        parser.add_option("--dump", dest="dump", action="store",
+                          metavar="FILE",
+                          help="Print the samples in a history file as CSV \
+                          and exit.")
+        parser.add_option("--since", dest="since", action="store",
+                          type="float",
+                          help="With --dump, start at this UNIX time.")
+        parser.add_option("--until", dest="until", action="store",
+                          type="float",
+                          help="With --dump, stop at this UNIX time.")
+        parser.add_option("--serve", dest="serve", action="store",
+                          type="int", metavar="PORT",
+                          help="Collect in the background every interval \
+                          and serve the latest sample as Prometheus text on \
+                          http://BIND:PORT/metrics.")
+        parser.add_option("--bind", dest="bind", action="store",
+                          metavar="ADDR",
+                          help="Address for --serve to listen on. \
+                          [default: %default]")
+        parser.add_option("--daemon", dest="daemon", action="store_true",
+                          help="Collect everything every interval and \
+                          answer other ddstats runs over --socket.")
+        parser.add_option("--socket", dest="socket", action="store",
+                          metavar="PATH",
+                          help="Unix socket of the ddstats daemon. \
+                          Single-sample runs read from it when a daemon \
+                          is listening. [default: %default]")
+        parser.add_option("--nodaemon", dest="nodaemon",
+                          action="store_true",
+                          help="Always collect locally, even when a daemon \
+                          is listening.")
+        parser.add_option("-P", "--psutil", dest="psutil",
+                          action="store_true",
+                          help="Collect through psutil even where the Linux \
+                          /proc fast path is available.")
+        parser.add_option("--selfstats", dest="selfstats",
+                          action="store_true",
+                          help="Report what each collector costs ddstats \
+                          itself: wall and CPU milliseconds, read and write \
+                          system calls and processes scanned, plus the load \
+                          of the whole process as a percentage of one CPU.")
+        parser.add_option("-c", "--count", dest="count", action="store",
+                          type="int",
+                          help="Collect this many samples, one per interval. \
+                          [default: %default]")
+        parser.add_option("-F", "--follow", dest="follow",
+                          action="store_true",
+                          help="Keep collecting one sample per interval \
+                          until interrupted.")
 
         # set defaults
         parser.set_defaults(verbose=False)
         parser.set_defaults(label=False)
-        parser.set_defaults(sample_interval=5)
+        parser.set_defaults(sample_interval=None)
         parser.set_defaults(cpu=False)
         parser.set_defaults(memory=False)
         parser.set_defaults(disk=False)
+        parser.set_defaults(disktimeout=DISKTIMEOUT)
         parser.set_defaults(diskio=False)
+        parser.set_defaults(diskstats=False)
+        parser.set_defaults(disks=None)
+        parser.set_defaults(nopartitions=False)
+        parser.set_defaults(novirtual=False)
         parser.set_defaults(procs=False)
         parser.set_defaults(handles=False)
+        parser.set_defaults(cgroups=False)
+        parser.set_defaults(cgroupdepth=2)
+        parser.set_defaults(cgroupfs=None)
+        parser.set_defaults(pressure=[])
+        parser.set_defaults(pressurefs=PRESSUREFS)
+        parser.set_defaults(top=0)
+        parser.set_defaults(sort='cpu')
         parser.set_defaults(all=False)
+        parser.set_defaults(rollup=None)
+        parser.set_defaults(format='text')
+        parser.set_defaults(rules=[])
+        parser.set_defaults(deadband=0.0)
+        parser.set_defaults(reldeadband=0.0)
+        parser.set_defaults(keyframe=60)
+        parser.set_defaults(history=None)
+        parser.set_defaults(dump=None)
+        parser.set_defaults(since=None)
+        parser.set_defaults(until=None)
+        parser.set_defaults(serve=None)
+        parser.set_defaults(bind='127.0.0.1')
+        parser.set_defaults(daemon=False)
+        parser.set_defaults(socket=DAEMONSOCKET)
+        parser.set_defaults(nodaemon=False)
+        parser.set_defaults(psutil=False)
+        parser.set_defaults(selfstats=False)
+        parser.set_defaults(count=1)
+        parser.set_defaults(follow=False)
 
         # process options
         (opts, args) = parser.parse_args(argv)
         if args:
             sys.argv.append['-h']
 
-        # reusables
-        processlist = []
+        if opts.dump:
+            dumphistory(opts.dump, opts.since, opts.until)
+            return 0
+        if opts.rollup and opts.format != 'text':
+            parser.error('--rollup is only printed with --format text')
+        if opts.rules and (opts.serve or opts.daemon):
+            parser.error('--rule is not evaluated by --serve or --daemon')
+        if opts.psutil:
+            global FASTPATH
+            FASTPATH = False
+        if opts.sample_interval is None:
+            # a lone CPU reading keeps the one-second window it always had,
+            # while disk IO and repeated samples keep five seconds
+            if (opts.diskio or opts.diskstats or opts.all or opts.follow or
+                    opts.count != 1 or opts.serve or opts.daemon):
+                opts.sample_interval = 5
+            else:
+                opts.sample_interval = 1
+        if opts.serve:
+            if not collectors(opts):
+                opts.all = True
+            cache = SampleCache()
+            startcollector(opts, cache)
+            servemetrics(opts, cache)
+            return 0
+        if opts.daemon:
+            opts.full = True
+            cache = SampleCache()
+            startcollector(opts, cache)
+            servedaemon(opts, cache)
+            return 0
+        if opts.follow:
+            opts.count = None
+        elif opts.count < 1:
+            parser.error('--count must be at least 1')
 
         # Handling our flags
-        if opts.cpu or opts.all:
-            if opts.label:
-                OUTERR('\n[CPU]')
-            OUTPUT(totalcpu())
-            if opts.verbose:
-                OUTPUT(totalcpu())
-        if opts.memory or opts.all:
-            if opts.label:
-                OUTERR('\n[MEMORY]')
-            if opts.verbose:
-                ratio = ramratio()
-                OUTPUT(ratio[0] + ' / ' + ratio[1])
-            else:
-                OUTPUT(str(ramused()))
-        if opts.disk or opts.all:
-            if opts.label:
-                OUTERR('\n[DISK]')
-            diskstatus = eachdiskspace()
-            for disk in diskstatus.keys():
-                OUTPUT(disk + ' :  ' + str(diskstatus[disk]))
-        if opts.diskio or opts.all:
-            if opts.label:
-                OUTERR('\n[DISKIO]')
-            if opts.verbose or opts.all:
-                diskstatus = eachdiskio(opts.sample_interval)
-                for disk in diskstatus.keys():
-                    OUTPUT(disk + ' :  ' + str(diskstatus[disk]))
-            else:
-                OUTPUT(totaldiskio(opts.sample_interval))
-        if opts.procs or opts.all:
-            if opts.label:
-                OUTERR('\n[PROCESSES]')
-            if opts.verbose:
-                if not processlist:
-                    processlist = psaux()
-                OUTPUT(str(uniqueprocesscount(processlist)) +
-                       ' unique from a total of ' + str(processcount()))
-            else:
-                OUTPUT(processcount())
-        if opts.handles or opts.all:
-            if opts.label:
-                OUTERR('\n[HANDLES]')
-            if not processlist:
-                processlist = psaux()
-            OUTPUT(fhcount(processlist))
+        try:
+            rules = [AlertRule(x) for x in opts.rules]
+        except ValueError as e:
+            parser.error(str(e))
+        # a rule collects its own metric, cgroups included, so it is never
+        # left with nothing to evaluate
+        opts.rulemetrics = [x.metric for x in rules]
+        for rule in rules:
+            if any(rulecovers(rule.metric, x + ':') for x in CGROUPSTATS):
+                opts.cgroups = True
+            if not rulecollected(opts, rule.metric):
+                parser.error('no metric of this run matches rule ' +
+                             repr(rule.spec))
+        answer = None
+        # the daemon walks no cgroups and ranks no processes, so those runs
+        # always collect here
+        if (opts.count == 1 and not opts.nodaemon and not opts.pressure and
+                not opts.selfstats and not opts.cgroups and not opts.top):
+            answer = querydaemon(opts.socket)
+        if opts.top:
+            # the first ranking sets the baseline for the interval's deltas
+            trackprocesses().rank(opts.top, opts.sort)
+        if opts.pressure:
+            samples = iterpressure([pressuretrigger(x)
+                                    for x in opts.pressure],
+                                   opts.sample_interval, opts.count,
+                                   cgroupsource(opts), opts.pressurefs)
+        elif answer is not None:
+            when, sample = answer
+            samples = [{'time': when, 'sample': selectsample(opts, sample)}]
+        elif needsrates(opts) or opts.count != 1:
+            samples = itersamples(opts.sample_interval, opts.count,
+                                  cgroupsource(opts))
+        else:
+            samples = [{}]
+        store = None
+        history = None
+        writer = None
+        if opts.format != 'text':
+            writer = SampleWriter(opts.format, sys.stdout, opts.deadband,
+                                  opts.reldeadband, opts.keyframe)
+        if opts.rollup:
+            store = MetricStore(opts.sample_interval)
+        try:
+            for rates in samples:
+                if 'sample' in rates:
+                    sample = rates['sample']
+                else:
+                    sample = collectsample(opts, rates)
+                when = rates.get('time') or time()
+                if writer is None:
+                    printsample(opts, sample)
+                else:
+                    writer.write(sample, when)
+                if store is not None:
+                    store.record(sample, when)
+                    printrollups(opts, store)
+                if opts.history:
+                    if history is None:
+                        history = HistoryFile(opts.history,
+                                              historycolumns(sample), True)
+                    history.append(when, sample)
+                for rule in rules:
+                    events = rule.observe(sample, when)
+                    printevents(opts, rule, events, when)
+                    if rule.firing:
+                        status = 1
+                sys.stdout.flush()
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # the reader went away, as head does; stop quietly, and point
+            # stdout at /dev/null so the flush at exit does not fail again
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            os.close(devnull)
+            return status
+        finally:
+            if history is not None:
+                history.close()
 
         # MAIN BODY #
 
-    except Exception, e:
+    except KeyboardInterrupt:
+        return status
+    except Exception as e:
         indent = len(program_name) * " "
         sys.stderr.write(program_name + ": " + repr(e) + "\n")
         sys.stderr.write(indent + "  for help use --help\n")
+        import traceback
         print(traceback.format_exc())
         return 2
 
-    return 0
+    return status
 
 
 if __name__ == "__main__":
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+ddstatsbench -- benchmarks for the ddstats collectors at scale
+
+ddstatsbench times psaux, uniqueprocesscount, fhcount, eachdiskio and
+eachdiskspace from ddstats.py against a big host made up on the spot:
+a fleet of sleeper processes holding many fds, a synthetic /proc/diskstats
+with many block devices, and a psutil stand-in that reports many mounts.
+Results go to a JSON baseline, and a later run compared against it flags
+every collector that got slower or hungrier than the tolerance allows.
+
+@license:    GNU General Public License, version 3
+'''
+
+import sys
+import os
+import tempfile
+from time import time
+from collections import namedtuple, OrderedDict
+from optparse import OptionParser
+import json
+
+import ddstats
+from ddstats import OUTPUT, OUTERR, sizeof_fmt
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__version__ = 0.1
+
+BENCHMARKS = ['psaux', 'uniqueprocesscount', 'fhcount', 'eachdiskio',
+              'eachdiskspace']
+
+Partition = namedtuple('Partition', ['device', 'mountpoint', 'fstype',
+                                     'opts'])
+Usage = namedtuple('Usage', ['total', 'used', 'free', 'percent'])
+
+
+def devicenames(disks, partitions):
+    '''Returns a list of (name, whole) pairs for disks synthetic block
+    devices with partitions partitions each.
+    >>> devicenames(1, 2)
+    [('xvdbench0', True), ('xvdbench0p1', False), ('xvdbench0p2', False)]
+    '''
+    names = []
+    for disk in range(disks):
+        names.append(('xvdbench%d' % disk, True))
+        for part in range(1, partitions + 1):
+            names.append(('xvdbench%dp%d' % (disk, part), False))
+    return(names)
+
+
+class FakePsutil(object):
+    '''Stands in for psutil with synthetic block devices and mounts and
+    hands everything else to the real module.  The counters of each device
+    advance on every call, so rates are never all zero.
+    '''
+
+    def __init__(self, real, devices, mounts):
+        self.real = real
+        self.devices = devices
+        self.calls = 0
+        disks = [name for name, _ in devices] or ['xvdbench0']
+        self.partitions = [Partition('/dev/' + disks[x % len(disks)],
+                                     '/bench/%d' % x, 'ext4', 'rw')
+                           for x in range(mounts)]
+
+    def __getattr__(self, attr):
+        return(getattr(self.real, attr))
+
+    def disk_partitions(self, all=False):
+        return(list(self.partitions))
+
+    def disk_usage(self, path):
+        return(Usage(1 << 40, 1 << 39, 1 << 39, 50.0))
+
+    def disk_io_counters(self, perdisk=False, nowrap=True):
+        self.calls += 1
+        each = OrderedDict()
+        for index, (name, _) in enumerate(self.devices):
+            n = self.calls * (index + 1)
+            each[name] = ddstats.DiskIO(n, n, n * 4096, n * 4096, n, n, 0,
+                                        0, n)
+        if perdisk:
+            return(each)
+        total = [0] * len(ddstats.DiskIO._fields)
+        for (name, whole), disk in zip(self.devices, each.values()):
+            if whole:
+                total = [x + y for x, y in zip(total, disk)]
+        return(ddstats.DiskIO(*total))
+
+
+def syntheticdiskstats(devices, path):
+    '''Writes a /proc/diskstats with one line per device in devices to
+    path and points ddstats at it instead of the real one.
+    '''
+    with open(path, 'w') as handle:
+        for index, (name, whole) in enumerate(devices):
+            n = index + 1
+            handle.write('%4d %7d %s %d %d %d %d %d %d %d %d 0 %d %d\n' %
+                         (202, index, name, n, 0, n * 8, n, n, 0, n * 8, n,
+                          n, 2 * n))
+            ddstats.wholedisks[name] = whole
+    ddstats.procfiles['/proc/diskstats'] = ddstats.ProcFile(path)
+
+
+class SleeperFleet(object):
+    '''A fleet of forked processes that each hold fds open descriptors and
+    sleep until the fleet is stopped or this process dies, which closes the
+    pipe they are blocked on.
+    '''
+
+    def __init__(self, procs, fds):
+        self.pids = []
+        held = [os.open(os.devnull, os.O_RDONLY) for _ in range(fds)]
+        self.reader, self.writer = os.pipe()
+        try:
+            for _ in range(procs):
+                pid = os.fork()
+                if pid == 0:
+                    os.close(self.writer)
+                    try:
+                        os.read(self.reader, 1)
+                    finally:
+                        os._exit(0)
+                self.pids.append(pid)
+        except OSError:
+            self.stop()
+            raise
+        finally:
+            for fd in held:
+                os.close(fd)
+            os.close(self.reader)
+
+    def stop(self):
+        if self.writer is not None:
+            os.close(self.writer)
+            self.writer = None
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.pids = []
+
+
+def benchmarkcalls():
+    '''Returns an ordered dictionary of each of BENCHMARKS and the call
+    that measures it.
+    '''
+    return(OrderedDict([
+        ('psaux', ddstats.psaux),
+        ('uniqueprocesscount', ddstats.uniqueprocesscount),
+        ('fhcount', ddstats.fhcount),
+        ('eachdiskio', lambda: ddstats.eachdiskio(0)),
+        ('eachdiskspace', ddstats.eachdiskspace),
+    ]))
+
+
+def measure(function, repeat=5):
+    '''Calls function once to warm up, then repeat times for the median and
+    best wall seconds, and once more under tracemalloc for the peak bytes
+    allocated, or None without tracemalloc.
+    '''
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time()
+        function()
+        times.append(time() - start)
+    times.sort()
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return(OrderedDict([('seconds', times[len(times) // 2]),
+                        ('best', times[0]), ('peakbytes', peak)]))
+
+
+def regressions(results, baseline, tolerance):
+    '''Returns a list of messages for every figure in results that exceeds
+    its counterpart in baseline by more than tolerance, a fraction.  Times
+    are compared on the best call, which is the least disturbed by whatever
+    else the host is doing.
+    >>> regressions({'x': {'best': 2.0, 'peakbytes': 10}},
+    ...             {'x': {'best': 1.0, 'peakbytes': 10}}, 0.25)
+    ['x best 2.0 against 1.0']
+    '''
+    found = []
+    for name, figures in results.items():
+        if name not in baseline:
+            continue
+        for key in ('best', 'peakbytes'):
+            now = figures.get(key)
+            then = baseline[name].get(key)
+            if now is None or not then:
+                continue
+            if now > then * (1 + tolerance):
+                found.append('%s %s %s against %s' % (name, key, now, then))
+    return(found)
+
+
+def main(argv=None):
+    '''Command line options parsing.  Takes arrays and returns an integers.
+    '''
+    program_name = os.path.basename(sys.argv[0])
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = OptionParser(version="%%prog %s" % __version__,
+                          description="Benchmark the ddstats collectors \
+                          against a synthetic big host.")
+    parser.add_option("-n", "--procs", dest="procs", action="store",
+                      type="int", help="Sleeper processes to spawn.")
+    parser.add_option("-f", "--fds", dest="fds", action="store",
+                      type="int", help="Open fds each sleeper holds.")
+    parser.add_option("--disks", dest="disks", action="store", type="int",
+                      help="Synthetic whole block devices.")
+    parser.add_option("--partitions", dest="partitions", action="store",
+                      type="int", help="Partitions on each synthetic disk.")
+    parser.add_option("--mounts", dest="mounts", action="store",
+                      type="int", help="Synthetic mount points.")
+    parser.add_option("-r", "--repeat", dest="repeat", action="store",
+                      type="int", help="Timed calls per collector.")
+    parser.add_option("-b", "--benchmark", dest="benchmarks",
+                      action="append", help="Run only this benchmark, \
+                      one of " + ', '.join(BENCHMARKS) + ".  Repeatable.")
+    parser.add_option("-s", "--save", dest="save", action="store",
+                      help="Write the results as a JSON baseline here.")
+    parser.add_option("-c", "--compare", dest="compare", action="store",
+                      help="Compare against this JSON baseline and exit 1 \
+                      on any regression.")
+    parser.add_option("-t", "--tolerance", dest="tolerance", action="store",
+                      type="float", help="Fraction a figure may exceed \
+                      the baseline by before it counts as a regression.")
+    parser.add_option("-P", "--psutil", dest="psutil", action="store_true",
+                      help="Collect through psutil even where the Linux \
+                      /proc fast path is available.")
+    parser.set_defaults(procs=2000, fds=64, disks=256, partitions=4,
+                        mounts=512, repeat=5, benchmarks=None, save=None,
+                        compare=None, tolerance=0.25, psutil=False)
+    (opts, args) = parser.parse_args(argv)
+    for name in opts.benchmarks or []:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark ' + repr(name))
+
+    import psutil
+    devices = devicenames(opts.disks, opts.partitions)
+    ddstats.psutil = FakePsutil(psutil, devices, opts.mounts)
+    if opts.psutil:
+        ddstats.FASTPATH = False
+    scratch = tempfile.mkdtemp(prefix='ddstatsbench')
+    diskstats = os.path.join(scratch, 'diskstats')
+    if ddstats.FASTPATH:
+        syntheticdiskstats(devices, diskstats)
+    fleet = None
+    try:
+        fleet = SleeperFleet(opts.procs, opts.fds)
+        results = OrderedDict()
+        for name, function in benchmarkcalls().items():
+            if opts.benchmarks and name not in opts.benchmarks:
+                continue
+            results[name] = measure(function, opts.repeat)
+            figures = results[name]
+            peak = figures['peakbytes']
+            OUTPUT('%s :  seconds %.4f best %.4f peak %s' % (
+                name, figures['seconds'], figures['best'],
+                'unknown' if peak is None else sizeof_fmt(peak)))
+    except KeyboardInterrupt:
+        return 0
+    except Exception as e:
+        OUTERR(program_name + ": " + repr(e))
+        return 2
+    finally:
+        if fleet is not None:
+            fleet.stop()
+        if ddstats.fdpool is not None:
+            ddstats.fdpool.terminate()
+            ddstats.fdpool = None
+        if os.path.exists(diskstats):
+            os.unlink(diskstats)
+        os.rmdir(scratch)
+
+    record = OrderedDict([
+        ('meta', OrderedDict([
+            ('procs', opts.procs), ('fds', opts.fds),
+            ('disks', opts.disks), ('partitions', opts.partitions),
+            ('mounts', opts.mounts), ('fastpath', ddstats.FASTPATH),
+            ('python', sys.version.split()[0]),
+            ('psutil', psutil.__version__), ('time', time())])),
+        ('results', results)])
+    if opts.save:
+        with open(opts.save, 'w') as handle:
+            json.dump(record, handle, indent=2)
+            handle.write('\n')
+    if opts.compare:
+        with open(opts.compare) as handle:
+            baseline = json.load(handle)
+        for key in ('procs', 'fds', 'disks', 'partitions', 'mounts',
+                    'fastpath'):
+            if baseline['meta'].get(key) != record['meta'][key]:
+                OUTERR('warning: baseline has %s %s, this run %s' % (
+                    key, baseline['meta'].get(key), record['meta'][key]))
+        found = regressions(results, baseline['results'], opts.tolerance)
+        for message in found:
+            OUTPUT('REGRESSION ' + message)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
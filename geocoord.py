@@ -14,12 +14,62 @@ import re
 import string
 import mgrs2geo
 
+## (U) compiled once; LAYOUT settles the layouts nearly every feed uses in one match:
+## (U) one to three numbers after or before each hemisphere letter, or a bare DD pair
+SEP='[^0-9.A-Za-z]'
+FIELDS='(\d+(?:\.\d+)?)(?:'+SEP+'+(\d+(?:\.\d+)?)(?:'+SEP+'+(\d+(?:\.\d+)?))?)?'
+LAYOUT=re.compile(SEP+'*(?:'+
+	FIELDS+SEP+'*([NSns])'+SEP+'*'+FIELDS+'(?:'+SEP+'*([EWew]))?|'+
+	'([NSns])'+SEP+'*'+FIELDS+SEP+'*([EWew])'+SEP+'*'+FIELDS+'|'+
+	'(\d+(?:\.\d+)?)'+SEP+'+(\d+(?:\.\d+)?))'+SEP+'*$')
+## (U) anything odd is tokenized by a single pass of TOKENS instead
+TOKENS=re.compile('([0-9.]+)|([NSns])|([EWew])')
+NUMBER=re.compile('\d+(?:\.\d+)?')
+DIGIT=re.compile('\d')
+NONNUMERIC=re.compile('[^0-9.]')
+## (U) digit runs that give away a muddled DD, DMS, or DM coordinate
+MUDDLEDDD=re.compile('\d\d?\.')
+MUDDLEDDMS=re.compile('\d{6}')
+MUDDLEDDM=re.compile('\d{4}')
+
 def DEBUG(*args):
 	print "\nDEBUG:  " + str(args)
 
 def CONSOLE(*args):
 	print "\nGEOCOORD:  " + str(args)
 
+def scan(coord):
+	## (U) returns the spans of the digit runs, the first of each hemisphere letter,
+	## (U) and the span left once junk is trimmed from both ends, all in one pass
+	runs=[]
+	lathemIndex=None
+	longhemIndex=None
+	begin=None
+	end=None
+	for token in TOKENS.finditer(coord):
+		start,stop=token.span()
+		if token.lastindex==1:
+			runs.append((start,stop))
+			run=token.group()
+			leading=len(run)-len(run.lstrip('.'))
+			## (U) a run of bare dots is junk at either end
+			if leading==len(run):  continue
+			start=start+leading
+			stop=stop-(len(run)-len(run.rstrip('.')))
+		elif token.lastindex==2:
+			if lathemIndex==None:  lathemIndex=start
+		elif longhemIndex==None:  longhemIndex=start
+		if begin==None:  begin=start
+		end=stop
+	## (U) like '$', the trimmed end keeps one trailing newline
+	if end!=None and coord[end:end+1]=='\n':  end=end+1
+	return(runs,lathemIndex,longhemIndex,begin,end)
+
+def fields(coord,runs,span):
+	## (U) the digit runs inside span, as string.split would find them once all else is blanked
+	first,last=span
+	return([coord[max(start,first):min(stop,last)] for start,stop in runs if max(start,first)<min(stop,last)])
+
 class geodetic:
 	def __init__(self,coord='0.00000N/0.00000E',coordtype=''):
 		## (U) coordtype can be MGRS, DMS, DM, or DD; DD is our goal; MGRS is unusable for now
@@ -37,104 +87,198 @@ class geodetic:
 		self.longhem=''
 		self.ddlat='0.00000'
 		self.ddlong='0.00000'
+		self.latfloat=0.0
+		self.longfloat=0.0
 		self.dd=''
 
-		coord=coord.replace('-',' ')
+		match=LAYOUT.match(coord)
+		if (match==None) or (not self.layout(match)):  self.parse(coord,match)
+		self.ddformat()
+
+	def layout(self, match):
+		## (U) settles a LAYOUT match with sane values; returns 0, leaving the instance untouched, otherwise
+		groups=match.groups()
+		if groups[3]!=None:
+			parts=groups[0:3]+groups[4:7]
+			lathem=groups[3]
+			longhem=groups[7] or 'E'
+		elif groups[8]!=None:
+			parts=groups[9:12]+groups[13:16]
+			lathem=groups[8]
+			longhem=groups[12]
+		else:
+			parts=(groups[16],0,0,groups[17],0,0)
+			lathem='N'
+			longhem='E'
+		parts=[field or 0 for field in parts]
+		values=map(float,parts)
+		if (values[0]>180) or (values[3]>180):  return(self.packed(match,parts[0],parts[3],lathem,longhem))
+		if max(values[1],values[2],values[4],values[5])>60:  return(0)
+
+		## (U) like assignvals, the longitude has the last word on the type
+		if parts[5]:  self.coordtype='DMS'
+		elif parts[4]:  self.coordtype='DM'
+		else:  self.coordtype='DD'
+		self.lathem=lathem
+		self.longhem=longhem
+		self.lat, self.latmin, self.latsec, self.long, self.longmin, self.longsec = parts
+		self.degrees(values)
+		return(1)
+
+	def packed(self, match, lat, long, lathem, longhem):
+		## (U) settles the usual muddled feed, one bare run of DDMMSS or DDMM.mm digits on each side of the
+		## (U) hemisphere letters, as the guesswork in parse would; returns 0, leaving the instance untouched, otherwise
+		coord=match.string
+		if match.lastindex==8:
+			latspan=(match.start(1),match.start(4))
+			longspan=(match.start(5),match.start(8))
+		elif (match.lastindex==14) and (coord[match.end(14):match.end(14)+1]!='\n'):
+			latspan=(match.end(9),match.start(13))
+			longspan=(match.end(13),match.end(14))
+		else:  return(0)
+		if (coord[latspan[0]:latspan[1]]!=lat) or (coord[longspan[0]:longspan[1]]!=long):  return(0)
+		latint,dot,latfrac=lat.partition('.')
+		longint,dot,longfrac=long.partition('.')
+		if (len(latint)>=6) and (lat==latint) and (long==longint) and (len(long)>=5):
+			self.coordtype='DMS'
+			parts=(lat[:-4],lat[-4:-2],lat[-2:],long[:-4],long[-4:-2],long[-2:])
+		elif (4<=len(latint)<6) and (len(longint)>=3):
+			self.coordtype='DM'
+			latmin=latint[-2:]
+			if latfrac:  latmin=latmin+'.'+latfrac
+			longmin=longint[-2:]
+			if longfrac:  longmin=longmin+'.'+longfrac
+			parts=(latint[:-2],latmin,0,longint[:-2],longmin,0)
+		else:  return(0)
+		self.lathem=lathem
+		self.longhem=longhem
+		self.lat, self.latmin, self.latsec, self.long, self.longmin, self.longsec = parts
+		values=map(float,parts)
+		self.degrees(values)
+		self.sanitycheck(values)
+		return(1)
+
+	def breakpoints(self, coord, match=None):
+		## (U) sets the hemispheres and returns the fields and spans of latitude and longitude,
+		## (U) then where the coordinate begins and ends once junk is trimmed from both ends
+		if match!=None:
+			groups=match.groups()
+			end=match.end(match.lastindex)
+			if coord[end:end+1]=='\n':  end=end+1
+			if groups[3]!=None:
+				self.lathem=groups[3]
+				self.longhem=groups[7] or 'E'
+				if groups[7]==None:  longspan=(match.start(5),end)
+				else:  longspan=(match.start(5),match.start(8))
+				return(groups[0:3],groups[4:7],(match.start(1),match.start(4)),longspan,match.start(1),end)
+			if groups[8]!=None:
+				self.lathem=groups[8]
+				self.longhem=groups[12]
+				return(groups[9:12],groups[13:16],(match.start(9)+1,match.start(13)),(match.start(13)+1,end),match.start(9),end)
+			self.lathem='N'
+			self.longhem='E'
+			return(groups[16:17],groups[17:18],match.span(17),match.span(18),match.start(17),end)
 
-		while (not re.search('(?i)^[0-9nsew]',coord)): coord=coord[1:]
-		while (not re.search('(?i)[0-9nsew]$',coord)): coord=coord[:-1]
+		runs,lathemIndex,longhemIndex,begin,end=scan(coord)
+		if begin==None:  raise ValueError('no coordinates in ' + repr(coord))
 
 		## (U) set hemispheres -- and probable break points
-		lathemIndex=re.search('(?i)[ns]',coord)
-		longhemIndex=re.search('(?i)[ew]',coord)
 		if lathemIndex==None:  self.lathem='N'
-		else:
-			lathemIndex=lathemIndex.start()
-			self.lathem=coord[lathemIndex]
+		else:  self.lathem=coord[lathemIndex]
 		if longhemIndex==None:  self.longhem='E'
-		else:
-			longhemIndex=longhemIndex.start()
-			self.longhem=coord[longhemIndex]
+		else:  self.longhem=coord[longhemIndex]
 
 		## (U) hem-coord or coord-hem format?
 		if lathemIndex==None:
-			coordIterator=re.finditer('(\d){1,}(\.(\d){1,}){0,1}',coord)
-			latitude=coordIterator.next().group()
-			longitude=coordIterator.next().group()
-		if lathemIndex>0:
-			latitude=coord[:lathemIndex]
-			longitude=coord[lathemIndex+1+re.search('\d',coord[lathemIndex+1:]).start():longhemIndex]
-		if lathemIndex==0:
-			latitude=coord[1:longhemIndex]
-			longitude=coord[longhemIndex+1:]
-
-		## (U) remove extra characters from latitude and longitude
-		for samplechar in latitude:
-			if (not re.search('[0-9\.]',samplechar)): latitude=latitude.replace(samplechar,' ')
-		for samplechar in longitude:
-			if (not re.search('[0-9\.]',samplechar)): longitude=longitude.replace(samplechar,' ')
-
-		self.lat, self.latmin, self.latsec = self.assignvals(string.split(latitude))
-		self.long, self.longmin, self.longsec = self.assignvals(string.split(longitude))
-
-		self.sanitycheck()
+			numbers=NUMBER.finditer(coord)
+			try:
+				latspan=numbers.next().span()
+				longspan=numbers.next().span()
+			except StopIteration:
+				raise ValueError('no longitude in ' + repr(coord))
+		elif lathemIndex>begin:
+			digit=DIGIT.search(coord,lathemIndex+1)
+			if digit==None:  raise ValueError('no longitude in ' + repr(coord))
+			latspan=(begin,lathemIndex)
+			if longhemIndex==None:  longspan=(digit.start(),end)
+			else:  longspan=(digit.start(),longhemIndex)
+		else:
+			if longhemIndex==None:  raise ValueError('no longitude hemisphere in ' + repr(coord))
+			latspan=(lathemIndex+1,longhemIndex)
+			longspan=(longhemIndex+1,end)
+		return(fields(coord,runs,latspan),fields(coord,runs,longspan),latspan,longspan,begin,end)
+
+	def parse(self, coord, match=None):
+		latfields,longfields,latspan,longspan,begin,end=self.breakpoints(coord,match)
+		self.lat, self.latmin, self.latsec = self.assignvals([field for field in latfields if field!=None])
+		self.long, self.longmin, self.longsec = self.assignvals([field for field in longfields if field!=None])
+
+		values=self.values()
+		self.sanitycheck(values)
 
 		## (U) begin grueling guesswork
 		if self.muddled:
-			if (re.search('^(\d\.|\d\d\.)',latitude)):
+			latitude=NONNUMERIC.sub(' ',coord[latspan[0]:latspan[1]])
+			longitude=NONNUMERIC.sub(' ',coord[longspan[0]:longspan[1]])
+			if MUDDLEDDD.match(latitude):
 				self.coordtype='DD'
-				self.ddlat=latitude
-				self.ddlong=longitude
-			else:
-				if (re.search('^(\d){6,7}',latitude)):
-					self.coordtype='DMS'
-					self.lat=latitude[:-4]
-					self.latmin=latitude[-4:-2]
-					self.latsec=latitude[-2:]
-					self.long=longitude[:-4]
-					self.longmin=longitude[-4:-2]
-					self.longsec=longitude[-2:]
-				else:
-					if (re.search('^(\d){4,5}',latitude)):
-						self.coordtype='DM'
-						latitude=string.split(latitude,'.')
-						self.lat=latitude[0][:-2]
-						self.latmin=latitude[0][-2:]
-						if (len(latitude)>1):  self.latmin=self.latmin+'.'+latitude[1]
-						longitude=string.split(longitude,'.')
-						self.long=longitude[0][:-2]
-						self.longmin=longitude[0][-2:]
-						if (len(longitude)>1):  self.longmin=self.longmin+'.'+longitude[1]
+			elif MUDDLEDDMS.match(latitude):
+				self.coordtype='DMS'
+				self.lat=latitude[:-4]
+				self.latmin=latitude[-4:-2]
+				self.latsec=latitude[-2:]
+				self.long=longitude[:-4]
+				self.longmin=longitude[-4:-2]
+				self.longsec=longitude[-2:]
+			elif MUDDLEDDM.match(latitude):
+				self.coordtype='DM'
+				latitude=latitude.split('.')
+				self.lat=latitude[0][:-2]
+				self.latmin=latitude[0][-2:]
+				if (len(latitude)>1):  self.latmin=self.latmin+'.'+latitude[1]
+				longitude=longitude.split('.')
+				self.long=longitude[0][:-2]
+				self.longmin=longitude[0][-2:]
+				if (len(longitude)>1):  self.longmin=self.longmin+'.'+longitude[1]
 			self.muddled=0
+			values=self.values()
+
+		self.degrees(values)
 
+		## (U) admit failure by leaving self.dd equal to self.input
+		self.sanitycheck(values)
+		if self.muddled:  self.dd=coord[begin:end].replace('-','').replace(' ','')
+
+	def degrees(self, values):
+		## (U) sets DD from the six values, as strings for display and floats for DM and DMS
 		if ((self.coordtype=='DMS') or (self.coordtype=='DM')):
-			ilat=string.atof(self.lat)
-			ilatmin=string.atof(self.latmin)
-			ilatsec=string.atof(self.latsec)
-			ilong=string.atof(self.long)
-			ilongmin=string.atof(self.longmin)
-			ilongsec=string.atof(self.longsec)
-			self.ddlat = str(round(((ilatmin*60 + ilatsec)/3600 + ilat),5))
-			self.ddlong = str(round(((ilongmin*60 + ilongsec)/3600 + ilong),5))
+			self.ddlat = str(round(((values[1]*60 + values[2])/3600 + values[0]),5))
+			self.ddlong = str(round(((values[4]*60 + values[5])/3600 + values[3]),5))
+			## (U) read back what DD prints so that DM and DMS always agree with it
+			self.latfloat = float(self.ddlat)
+			self.longfloat = float(self.ddlong)
 		elif (self.coordtype=='DD'):
 			self.ddlat = self.lat
 			self.ddlong = self.long
+			self.latfloat = values[0]
+			self.longfloat = values[3]
 
-		## (U) admit failure by leaving self.dd equal to self.input
-		self.sanitycheck()
-		if self.muddled:  self.dd=coord.replace(' ','')
-		self.ddformat()
-		self.dmformat()
-		self.dmsformat()
+	def __getattr__(self, name):
+		## (U) DD is our goal, so DM and DMS are only worked out when first asked for
+		if name=='dm':  self.dmformat()
+		elif name=='dms':  self.dmsformat()
+		else:  raise AttributeError(name)
+		return(self.__dict__[name])
+
+	def values(self):
+		## (U) degrees, minutes, and seconds of latitude, then of longitude, as floats
+		return([float(value) for value in (self.lat, self.latmin, self.latsec, self.long, self.longmin, self.longsec)])
 
-	def sanitycheck(self):
+	def sanitycheck(self, values=None):
+		if values==None:  values=self.values()
 		if self.coordtype=='':  self.muddled=1
-		if abs(string.atof(self.lat))>180:  self.muddled=1
-		if abs(string.atof(self.latmin))>60:  self.muddled=1
-		if abs(string.atof(self.latsec))>60:  self.muddled=1
-		if abs(string.atof(self.long))>180:  self.muddled=1
-		if abs(string.atof(self.longmin))>60:  self.muddled=1
-		if abs(string.atof(self.longsec))>60:  self.muddled=1
+		if (abs(values[0])>180) or (abs(values[3])>180):  self.muddled=1
+		if max(abs(values[1]),abs(values[2]),abs(values[4]),abs(values[5]))>60:  self.muddled=1
 
 	def assignvals(self, valList):
 		## (U) assign values based on the spacing
@@ -165,8 +309,8 @@ class geodetic:
 			self.dd = [ self.ddlat, self.ddlong ]
 
 	def dmformat(self, separator=None):
-		latFloat = string.atof(self.ddlat)
-		longFloat = string.atof(self.ddlong)
+		latFloat = self.latfloat
+		longFloat = self.longfloat
 		latMin = 60.0 * (latFloat - int(latFloat))
 		longMin = 60.0 * (longFloat - int(longFloat))
 		if separator:
@@ -175,8 +319,8 @@ class geodetic:
 			self.dm = [ str(int(latFloat)) + ' ' + str(round(latMin,5)) + self.lathem, str(int(longFloat)) + ' ' + str(round(longMin,5)) + self.longhem ]
 
 	def dmsformat(self, separator=None):
-		latFloat = string.atof(self.ddlat)
-		longFloat = string.atof(self.ddlong)
+		latFloat = self.latfloat
+		longFloat = self.longfloat
 		latMin = 60.0 * (latFloat - int(latFloat))
 		longMin = 60.0 * (longFloat - int(longFloat))
 		latSec = 60 * (latMin - int(latMin))